@@ -4,18 +4,25 @@ from __future__ import absolute_import
 
 from builtins import zip, range
 import os, re, copy, itertools
+import multiprocessing, hashlib, pickle, json, warnings
 
 import pandas as pd
 import numpy as np
 import torch
 from torch.utils.data import Dataset
 
+# Version of the cached dataset format, which is part of the cache key,
+# so this must be bumped whenever loading, resampling or encoding changes
+CACHE_VERSION = 1
+
 class MultiseqDataset(Dataset):
     """Multimodal dataset for (synchronous) time series and sequential data."""
 
     def __init__(self, modalities, dirs, regex, preprocess, rates,
                  base_rate=None, truncate=False,
-                 ids_as_mods=[], item_as_dict=False):
+                 ids_as_mods=[], item_as_dict=False,
+                 dtypes=None, scales=None, keep_orig=True, lazy=False,
+                 num_workers=0, cache_dir=None):
         """Loads valence ratings and features for each modality.
 
         modalities -- names of each input modality
@@ -27,6 +34,20 @@ class MultiseqDataset(Dataset):
         truncate -- if true, truncate to modality with minimum length
         ids_as_mods -- add sequence ids as modalities with these names
         item_as_dict -- whether to return data as dictionary
+        dtypes -- storage dtypes of each modality (default: float64),
+                  e.g. 'float16', 'float32', or 'uint8' for images
+                  (integer dtypes only track missing timesteps, so any
+                  timestep with a NaN is returned as entirely NaN)
+        scales -- quantization step for integer dtypes, defaulting to
+                  1/max so that [0,1] (or [-1,1]) spans the full range
+        keep_orig -- whether to retain the data before resampling in orig
+        lazy -- memory-map .npy files instead of loading them, resampling
+                on access (lazily loaded modalities are stored as float64,
+                ignoring dtypes)
+        num_workers -- load files with this many processes (default: 0),
+                       which inherit the preprocessing functions by forking
+        cache_dir -- directory in which to cache the loaded dataset, keyed
+                     by the arguments above and the files' modification times
         """
         # Store arguments
         self.modalities = modalities
@@ -49,6 +70,13 @@ class MultiseqDataset(Dataset):
         if type(preprocess) is not list:
             preprocess = [preprocess] * len(self.modalities)
         preprocess = {m: p for m, p in zip(modalities, preprocess)}
+        if type(dtypes) is not list:
+            dtypes = [dtypes] * len(self.modalities)
+        if type(scales) is not list:
+            scales = [scales] * len(self.modalities)
+        self.dtypes, self.scales, self.missing = dict(), dict(), dict()
+        for m, dtype, scale in zip(modalities, dtypes, scales):
+            self.set_dtype(m, dtype, scale)
 
         # Load filenames into lists and extract regex-captured sequence IDs
         paths = dict()
@@ -78,57 +106,83 @@ class MultiseqDataset(Dataset):
         self.seq_id_sets = [list(sorted(set(s_ids))) for s_ids in
                             list(zip(*self.seq_ids))]
 
+        # Load dataset in a single read if it has been cached
+        cache_path = None
+        if cache_dir is not None:
+            config = (CACHE_VERSION, modalities, dirs, regex, preprocess,
+                      self.rates, self.base_rate, truncate, ids_as_mods,
+                      dtypes, scales, keep_orig, lazy)
+            cache_path = os.path.join(cache_dir, 'multiseq_{}.pkl'.format(
+                cache_key(config, paths)))
+            if os.path.exists(cache_path):
+                with open(cache_path, 'rb') as f:
+                    self.__dict__.update(pickle.load(f))
+                self.item_as_dict = item_as_dict
+                return
+
         # Compute ratio to base rate
         self.ratios = {m: r/self.base_rate for m, r in
                        zip(self.modalities, self.rates)}
 
         # Load data from files
         self.data = {m: [] for m in modalities}
-        self.orig = {m: [] for m in modalities}
+        self.orig = {m: [] for m in modalities} if keep_orig else dict()
         self.lengths = []
-        for i in range(len(self.seq_ids)):
-            seq_len = float('inf')
-            # Load each input modality
-            for m, data in self.data.items():
-                fp = paths[m][i]
-                if re.match("^.*\.npy", fp):
-                    # Load as numpy array
-                    d = np.load(fp)
-                elif re.match("^.*\.(csv|txt)", fp):
-                    # Use pandas to read and pre-process CSV files
-                    d = pd.read_csv(fp)
-                    d = np.array(preprocess[m](d))
-                elif re.match("^.*\.tsv", fp):
-                    d = pd.read_csv(fp, sep='\t')
-                    d = np.array(preprocess[m](d))
-                # Convert to float to allow NaNs for missing values
-                d = d.astype(float)
+        # Memory-map modalities stored as .npy files if lazy
+        lazy = [m for m in modalities if lazy and
+                all(re.match("^.*\.npy", fp) for fp in paths[m])]
+        for m in lazy:
+            # Memory-mapped data is read as floats, whatever the dtype, and
+            # deletions can't be written to file, so track them separately
+            self.set_dtype(m, None)
+            self.missing[m] = []
+        # Load (and resample) remaining modalities, in parallel if requested
+        eager = [m for m in modalities if m not in lazy]
+        load_args = ({m: paths[m] for m in eager}, preprocess,
+                     self.ratios, keep_orig, self.encode)
+        n_seqs, pool = len(self.seq_ids), None
+        if num_workers > 0:
+            # Workers must be forked to inherit the preprocessing functions
+            try:
+                context = multiprocessing.get_context('fork')
+            except ValueError:
+                warnings.warn("Cannot fork loader processes on this "
+                              "platform, loading files serially instead.")
+                num_workers = 0
+        if num_workers > 0:
+            pool = context.Pool(num_workers, _init_loader, (load_args,))
+            loaded = pool.imap(_load_seq, range(n_seqs),
+                               max(1, n_seqs // (num_workers * 16)))
+        else:
+            loaded = (load_seq(i, *load_args) for i in range(n_seqs))
+        try:
+            for i, seq in enumerate(loaded):
+                if num_workers > 0 and (i+1) % max(1, n_seqs // 10) == 0:
+                    print("Loaded {}/{} sequences".format(i+1, n_seqs))
                 # Store original data before resampling
-                self.orig[m].append(d)
-                # Subsample/oversample data to base rate
-                ratio = self.ratios[m]
-                if ratio > 1:
-                    # Time average so that data is at base rate
-                    ratio = int(ratio)
-                    end = ratio * (len(d)//ratio)
-                    avg = np.mean(d[:end].reshape(-1, ratio, *d.shape[1:]), 1)
-                    if end < len(d):
-                        remain = d[end:].mean(axis=0)[np.newaxis,:]
-                        d = np.concatenate([avg, remain])
-                    else:
-                        d = avg
-                else:
-                    # Repeat so that data is at base rate
-                    ratio = int(1. / ratio)
-                    d = np.repeat(d, ratio, axis=0)
-                data.append(d)
-                if len(d) < seq_len:
-                    seq_len = len(d)
-            # Truncate to minimum sequence length
-            if truncate:
+                if keep_orig:
+                    for m in eager:
+                        self.orig[m].append(seq[m][0])
+                seq = {m: seq[m][1] for m in eager}
+                # Defer loading and resampling of lazy modalities until access
+                for m in lazy:
+                    d = LazySequence(paths[m][i], self.ratios[m])
+                    seq[m] = (d, np.zeros(len(d), bool))
+                    if keep_orig:
+                        self.orig[m].append(LazySequence(paths[m][i]))
+                seq_len = min(len(seq[m][0]) for m in self.modalities)
+                # Truncate to minimum sequence length, then store
                 for m in self.modalities:
-                    self.data[m][-1] = self.data[m][-1][:seq_len]
-            self.lengths.append(seq_len)
+                    d, missing = seq[m]
+                    self.data[m].append(d[:seq_len] if truncate else d)
+                    if missing is not None:
+                        self.missing[m].append(missing[:seq_len] if truncate
+                                               else missing)
+                self.lengths.append(seq_len)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         # Add information from sequence IDs as additional modalities
         self.ids_as_mods = ids_as_mods
@@ -136,8 +190,10 @@ class MultiseqDataset(Dataset):
             self.modalities.append(m)
             self.rates.append(self.base_rate)
             self.ratios[m] = 1.0
+            self.set_dtype(m, None)
             self.data[m] = []
-            self.orig[m] = []
+            if keep_orig:
+                self.orig[m] = []
         for seq_id, seq_len in zip(self.seq_ids, self.lengths):
             for k, m in enumerate(ids_as_mods):
                 # Ignore ID fields that are set to None
@@ -146,40 +202,98 @@ class MultiseqDataset(Dataset):
                 # Repeat ID field for the length of the whole sequence
                 d = self.seq_id_sets[k].index(seq_id[k])
                 d = np.array([[d]] * seq_len)
-                self.orig[m].append(d)
-                # Convert to float to allow NaNs for missing values
-                d = d.astype(float)
-                self.data[m].append(d)
+                if keep_orig:
+                    self.orig[m].append(d)
+                self.append(m, d)
+
+        if cache_path is not None:
+            save_cache(cache_path, self.__dict__)
 
     def __len__(self):
         return len(self.seq_ids)
 
     def __getitem__(self, i):
         if self.item_as_dict:
-            d = {m: self.data[m][i] for m in self.modalities}
+            d = {m: self.get(m, i) for m in self.modalities}
             d['length'] = self.lengths[i]
             return d
         else:
-            return tuple(self.data[m][i] for m in self.modalities)
+            return tuple(self.get(m, i) for m in self.modalities)
+
+    def set_dtype(self, m, dtype, scale=None):
+        """Sets storage dtype (and scale, if integer) of modality m.
+
+        Integer dtypes cannot represent NaNs, so missing timesteps of
+        those modalities are tracked separately in self.missing.
+        """
+        dtype = np.dtype(float if dtype is None else dtype)
+        self.dtypes[m] = dtype
+        self.scales[m] = None
+        self.missing.pop(m, None)
+        if np.issubdtype(dtype, np.integer):
+            if scale is None:
+                scale = 1. / np.iinfo(dtype).max
+            self.scales[m] = scale
+            self.missing[m] = []
+
+    def encode(self, m, d):
+        """Converts float array d into storage format of modality m,
+        returning the stored array and missing timesteps (if tracked)."""
+        dtype = self.dtypes[m]
+        if not np.issubdtype(dtype, np.integer):
+            return d.astype(dtype, copy=False), None
+        nan = np.isnan(d)
+        missing = nan.reshape(len(d), -1).any(axis=1)
+        info = np.iinfo(dtype)
+        d = np.round(np.where(nan, 0, d) / self.scales[m])
+        d = np.clip(d, info.min, info.max).astype(dtype)
+        return d, missing
+
+    def decode(self, m, d, missing=None):
+        """Converts stored array d of modality m back into floats,
+        with NaNs for missing timesteps."""
+        if m not in self.missing:
+            return d if d.itemsize >= 4 else d.astype(np.float32)
+        if isinstance(d, LazySequence):
+            d = d.load()
+        else:
+            d = d.astype(np.float32) * np.float32(self.scales[m])
+        d[missing] = float('nan')
+        return d
+
+    def append(self, m, d):
+        """Encodes and appends float array d to the data of modality m."""
+        d, missing = self.encode(m, d)
+        self.data[m].append(d)
+        if missing is not None:
+            self.missing[m].append(missing)
+
+    def get(self, m, i):
+        """Returns sequence i of modality m as floats (NaN if missing)."""
+        if m not in self.missing:
+            return self.decode(m, self.data[m][i])
+        return self.decode(m, self.data[m][i], self.missing[m][i])
 
     def mean_and_std(self, modalities=None):
         """Compute mean+std across time and samples for given modalities."""
         if modalities is None:
             modalities = self.modalities
-        m_mean = {m: np.nanmean(np.concatenate(self.data[m], 0), axis=0)
-                  for m in modalities}
-        m_std = {m: np.nanstd(np.concatenate(self.data[m], 0), axis=0)
-                 for m in modalities}
+        m_mean, m_std = dict(), dict()
+        for m in modalities:
+            data = np.concatenate([self.get(m, i) for i in range(len(self))])
+            m_mean[m] = np.nanmean(data, axis=0)
+            m_std[m] = np.nanstd(data, axis=0)
         return m_mean, m_std
 
     def max_and_min(self, modalities=None):
         """Compute max+min across time and samples for given modalities."""
         if modalities is None:
             modalities = self.modalities
-        m_max = {m: np.nanmax(np.stack([a.max(0) for a in self.data[m]]), 0)
-                 for m in modalities}
-        m_min = {m: np.nanmin(np.stack([a.min(0) for a in self.data[m]]), 0)
-                 for m in modalities}
+        m_max, m_min = dict(), dict()
+        for m in modalities:
+            data = [self.get(m, i) for i in range(len(self))]
+            m_max[m] = np.nanmax(np.stack([a.max(0) for a in data]), 0)
+            m_min[m] = np.nanmin(np.stack([a.min(0) for a in data]), 0)
         return m_max, m_min
 
     def normalize_(self, modalities=None, method='meanvar', ref_data=None):
@@ -197,15 +311,25 @@ class MultiseqDataset(Dataset):
             m_rng = {m: (m_max[m]-m_min[m]) for m in modalities}
             m_rng = {m: m_rng[m] * (m_rng[m] > 0) + 1e-10 * (m_rng[m] <= 0)
                      for m in modalities}
-            for m in modalities:
-                self.data[m] = [(a-m_min[m]) / m_rng[m] * 2 - 1 for
-                                a in self.data[m]]
+            norm = {m: lambda a, m=m: (a-m_min[m]) / m_rng[m] * 2 - 1
+                    for m in modalities}
         else:
             # Mean-variance normalization
             m_mean, m_std = ref_data.mean_and_std(modalities)
-            for m in modalities:
-                self.data[m] = [(a-m_mean[m]) / (m_std[m] + 1e-10) for
-                                a in self.data[m]]
+            norm = {m: lambda a, m=m: (a-m_mean[m]) / (m_std[m] + 1e-10)
+                    for m in modalities}
+        for m in modalities:
+            data = [norm[m](self.get(m, i)) for i in range(len(self))]
+            # Normalized data can't be quantized, so store as floats
+            # (lazily loaded modalities are also loaded into memory)
+            if m in self.missing:
+                dtype = self.dtypes[m]
+                if np.issubdtype(dtype, np.integer):
+                    dtype = np.float32
+                self.set_dtype(m, dtype)
+            self.data[m] = []
+            for d in data:
+                self.append(m, d)
 
     def normalize(self, modalities=None, method='meanvar', ref_data=None):
         """Normalize data (returns new dataset)."""
@@ -223,7 +347,10 @@ class MultiseqDataset(Dataset):
             split = [n for l in self.lengths]
         for m in self.modalities:
             self.data[m] = list(itertools.chain.from_iterable(
-                [np.array_split(a, s, 0) for a,s in zip(self.data[m], split)]))
+                [split_seq(a, s) for a,s in zip(self.data[m], split)]))
+        for m in self.missing:
+            self.missing[m] = list(itertools.chain.from_iterable(
+                [split_seq(a, s) for a,s in zip(self.missing[m], split)]))
         if n_is_len:
             self.seq_ids = list(itertools.chain.from_iterable(
                 [[i] * (len(s)+1) for i,s in zip(self.seq_ids, split)]))
@@ -233,8 +360,15 @@ class MultiseqDataset(Dataset):
         self.lengths = [len(d) for d in self.data[self.modalities[0]]]
 
     def split(self, n, n_is_len=True):
-        """Splits each sequence into chunks (returns new dataset)."""
-        dataset = copy.deepcopy(self)
+        """Splits each sequence into chunks (returns new dataset).
+
+        Chunks are views of the sequences in this dataset rather than
+        copies, so in-place changes (e.g. by corrupt_) affect both.
+        """
+        dataset = copy.copy(self)
+        # Copy containers that split_ and other methods reassign into
+        for attr in ['data', 'missing', 'orig', 'dtypes', 'scales']:
+            setattr(dataset, attr, dict(getattr(self, attr)))
         dataset.split_(n, n_is_len)
         return dataset
 
@@ -263,7 +397,10 @@ class MultiseqDataset(Dataset):
         for m in modalities:
             for i in range(len(self.data[m])):
                 del_idx = del_func(len(self.data[m][i]))
-                self.data[m][i][del_idx] = float('nan')
+                if m in self.missing:
+                    self.missing[m][i][del_idx] = True
+                else:
+                    self.data[m][i][del_idx] = float('nan')
 
     def corrupt(self, del_frac, mode='uniform', modalities=None):
         """Corrupt dataset by randomly deleting data (return new dataset)."""
@@ -295,6 +432,9 @@ class MultiseqDataset(Dataset):
         sel.lengths = [sel.lengths[i] for i in idx]
         for m in self.modalities:
             sel.data[m] = [sel.data[m][i] for i in idx]
+        for m in sel.missing:
+            sel.missing[m] = [sel.missing[m][i] for i in idx]
+        for m in sel.orig:
             sel.orig[m] = [sel.orig[m][i] for i in idx]
         return sel
 
@@ -305,6 +445,8 @@ class MultiseqDataset(Dataset):
             raise Exception("Modalities need to match.")
         if (set1.base_rate != set2.base_rate):
             raise Exception("Base rates need to match.")
+        if (set1.dtypes != set2.dtypes or set1.scales != set2.scales):
+            raise Exception("Storage dtypes need to match.")
         merged = copy.deepcopy(set1)
         merged.orig.clear()
         merged.seq_ids += set2.seq_ids
@@ -315,8 +457,239 @@ class MultiseqDataset(Dataset):
         merged.ratios = [1] * len(merged.modalities)
         for m in merged.modalities:
             merged.data[m] += copy.deepcopy(set2.data[m])
+        for m in merged.missing:
+            merged.missing[m] += copy.deepcopy(set2.missing[m])
         return merged
 
+    def to_packed(self, path):
+        """Saves dataset in packed format, i.e. a directory with one .npy
+        array per modality (sequences concatenated along time), plus a
+        JSON manifest with the offsets of each sequence.
+
+        Data is stored in the storage dtype of each modality, with any
+        missing timesteps of integer dtypes in a separate array.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        offsets = dict()
+        for m in self.modalities:
+            lengths = [len(d) for d in self.data[m]]
+            offsets[m] = [0] + np.cumsum(lengths).tolist()
+            shape = (offsets[m][-1],) + self.get(m, 0).shape[1:]
+            data = np.lib.format.open_memmap(
+                os.path.join(path, m + '.npy'), 'w+',
+                self.dtypes[m], shape)
+            if m in self.missing:
+                missing = np.lib.format.open_memmap(
+                    os.path.join(path, m + '_missing.npy'), 'w+',
+                    bool, shape[:1])
+            # Write one sequence at a time to avoid loading everything
+            for i, (start, stop) in enumerate(zip(offsets[m][:-1],
+                                                  offsets[m][1:])):
+                d, missing_i = self.encode(m, self.get(m, i))
+                data[start:stop] = d
+                if missing_i is not None:
+                    missing[start:stop] = missing_i
+            del data
+            if m in self.missing:
+                del missing
+        manifest = {
+            'modalities': self.modalities,
+            'rates': self.rates,
+            'base_rate': self.base_rate,
+            'ratios': self.ratios,
+            'dtypes': {m: self.dtypes[m].name for m in self.modalities},
+            'scales': {m: self.scales[m] for m in self.modalities},
+            'ids_as_mods': self.ids_as_mods,
+            'seq_ids': self.seq_ids,
+            'seq_id_sets': self.seq_id_sets,
+            'lengths': self.lengths,
+            'offsets': offsets
+        }
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+    @classmethod
+    def from_packed(cls, path, item_as_dict=False):
+        """Loads dataset saved by to_packed, memory-mapping each modality
+        so that sequences are read on access.
+
+        Arrays are mapped copy-on-write, so in-place changes to the
+        dataset (e.g. by corrupt_) never modify the packed files.
+        """
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        dataset = cls.__new__(cls)
+        dataset.modalities = manifest['modalities']
+        dataset.rates = manifest['rates']
+        dataset.base_rate = manifest['base_rate']
+        dataset.ratios = manifest['ratios']
+        dataset.item_as_dict = item_as_dict
+        dataset.ids_as_mods = manifest['ids_as_mods']
+        dataset.seq_ids = [tuple(s) for s in manifest['seq_ids']]
+        dataset.seq_id_sets = manifest['seq_id_sets']
+        dataset.lengths = manifest['lengths']
+        dataset.dtypes, dataset.scales = dict(), dict()
+        dataset.missing = dict()
+        dataset.data, dataset.orig = dict(), dict()
+        for m in dataset.modalities:
+            dataset.set_dtype(m, manifest['dtypes'][m], manifest['scales'][m])
+            offsets = manifest['offsets'][m]
+            bounds = list(zip(offsets[:-1], offsets[1:]))
+            data = np.load(os.path.join(path, m + '.npy'), mmap_mode='c')
+            dataset.data[m] = [data[start:stop] for start, stop in bounds]
+            if m in dataset.missing:
+                missing = np.load(os.path.join(path, m + '_missing.npy'),
+                                  mmap_mode='c')
+                dataset.missing[m] = [missing[start:stop]
+                                      for start, stop in bounds]
+        return dataset
+
+def cache_key(config, paths):
+    """Hashes dataset config and the paths and modification times of its
+    files, identifying preprocessing functions by their bytecode, along
+    with their default arguments and the values they close over."""
+    seen = set()
+    def code_key(code):
+        consts = [code_key(c) if hasattr(c, 'co_code') else repr(c)
+                  for c in code.co_consts]
+        return (code.co_code, consts, code.co_names)
+    def fn_key(f):
+        if not hasattr(f, '__code__'):
+            return repr(f)
+        if id(f) in seen:
+            # Avoid recursing into functions that refer to themselves
+            return f.__name__
+        seen.add(id(f))
+        cells = [c.cell_contents for c in (f.__closure__ or [])]
+        return (code_key(f.__code__), to_key(cells),
+                to_key(f.__defaults__ or []),
+                to_key(getattr(f, '__kwdefaults__', None) or {}))
+    def to_key(x):
+        if isinstance(x, dict):
+            return sorted((k, to_key(v)) for k, v in x.items())
+        if isinstance(x, (list, tuple)):
+            return [to_key(v) for v in x]
+        return fn_key(x) if callable(x) else x
+    files = [(fp, os.path.getmtime(fp), os.path.getsize(fp))
+             for m in sorted(paths) for fp in paths[m]]
+    return hashlib.sha1(repr((to_key(config), files)).encode()).hexdigest()
+
+def save_cache(path, state):
+    """Writes dataset state to path as a single pickle, replacing any
+    existing file only once writing has finished."""
+    cache_dir = os.path.dirname(path)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+
+def load_file(fp, preprocess=None):
+    """Loads .npy, .csv/.txt or .tsv file as a float array."""
+    if re.match("^.*\.npy", fp):
+        # Load as numpy array
+        d = np.load(fp)
+    elif re.match("^.*\.(csv|txt)", fp):
+        # Use pandas to read and pre-process CSV files
+        d = pd.read_csv(fp)
+        d = np.array(preprocess(d))
+    elif re.match("^.*\.tsv", fp):
+        d = pd.read_csv(fp, sep='\t')
+        d = np.array(preprocess(d))
+    # Convert to float to allow NaNs for missing values
+    return d.astype(float)
+
+def load_seq(i, paths, preprocess, ratios, keep_orig, encode):
+    """Loads sequence i from the paths of each modality, returning the
+    original data (if kept) and the resampled data after encoding, i.e.
+    an (array, missing) pair, for each modality."""
+    seq = dict()
+    for m in paths:
+        d = load_file(paths[m][i], preprocess[m])
+        seq[m] = (d if keep_orig else None, encode(m, resample(d, ratios[m])))
+    return seq
+
+# Arguments to load_seq, which are inherited by forked loader processes
+_load_args = None
+
+def _init_loader(load_args):
+    global _load_args
+    _load_args = load_args
+
+def _load_seq(i):
+    return load_seq(i, *_load_args)
+
+class LazySequence(object):
+    """Sequence in a memory-mapped .npy file, which is only read and
+    resampled (see resample) when loaded. Slicing returns a new lazy
+    sequence, with start and stop in resampled timesteps."""
+
+    def __init__(self, path, ratio=1.0, start=0, stop=None):
+        self.path = path
+        self.ratio = ratio
+        if stop is None:
+            # Compute length after resampling from the header alone
+            stop = len(np.load(path, mmap_mode='r'))
+            if ratio > 1:
+                stop = -(-stop // int(ratio))
+            else:
+                stop = stop * int(1. / ratio)
+        self.start, self.stop = start, stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            return self.load()[key]
+        start, stop, _ = key.indices(len(self))
+        return LazySequence(self.path, self.ratio,
+                            self.start + start, self.start + max(start, stop))
+
+    def load(self):
+        """Reads and resamples sequence into a new float array."""
+        d = np.load(self.path, mmap_mode='r')
+        if self.ratio > 1:
+            # Read whole averaging windows
+            r = int(self.ratio)
+            d = resample(d[self.start*r:self.stop*r], self.ratio)
+        elif self.ratio < 1:
+            # Read every repeated timestep, then trim
+            r = int(1. / self.ratio)
+            start, offset = self.start // r, self.start % r
+            d = resample(d[start:-(-self.stop // r)], self.ratio)
+            d = d[offset:offset+len(self)]
+        else:
+            d = d[self.start:self.stop]
+        return np.array(d, dtype=float)
+
+def resample(d, ratio):
+    """Subsample/oversample data by ratio relative to the base rate."""
+    if ratio > 1:
+        # Time average so that data is at base rate
+        ratio = int(ratio)
+        end = ratio * (len(d)//ratio)
+        avg = np.mean(d[:end].reshape(-1, ratio, *d.shape[1:]), 1)
+        if end < len(d):
+            remain = d[end:].mean(axis=0)[np.newaxis,:]
+            d = np.concatenate([avg, remain])
+        else:
+            d = avg
+    else:
+        # Repeat so that data is at base rate
+        ratio = int(1. / ratio)
+        d = np.repeat(d, ratio, axis=0)
+    return d
+
+def split_seq(seq, split):
+    """Splits seq into chunks like np.array_split, but by slicing so that
+    lazy sequences can be split as well."""
+    idx = np.array_split(np.arange(len(seq)), split)
+    bounds = np.cumsum([0] + [len(i) for i in idx])
+    return [seq[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
 def len_to_mask(lengths, time_first=True):
     """Converts list of sequence lengths to a mask tensor."""
     mask = torch.arange(max(lengths)).expand(len(lengths), max(lengths))
@@ -368,21 +741,40 @@ def seq_collate(data, time_first=True):
     mask = len_to_mask(lengths, time_first)
     return tuple(padded + [mask, lengths])
 
-def seq_collate_dict(data, time_first=True):
-    """Collate that accepts and returns dictionaries of batch tensors."""
+def seq_collate_dict(data, time_first=True, obs_masks=False):
+    """Collate that accepts and returns dictionaries of batch tensors.
+
+    If obs_masks is true, missing values are zero-filled instead of NaN,
+    and a dictionary of (T, B) masks for observed timesteps is returned
+    as well. Timesteps with any missing values are treated as missing.
+    """
     batch = {}
     modalities = [k for k in data[0] if  k != 'length']
     order = sorted(range(len(data)),
                    key=lambda i: data[i]['length'], reverse=True)
     data.sort(key=lambda d: d['length'], reverse=True)
     lengths = [d['length'] for d in data]
+    masks = {}
     for m in modalities:
         m_data = [d[m] for d in data]
         m_padded = pad_and_merge(m_data, max(lengths))
+        if obs_masks:
+            # Compute masks once, then zero-fill missing values
+            nan_mask = torch.isnan(m_padded)
+            masks[m] = 1 - nan_mask.flatten(2, -1).any(dim=-1)
+            masks[m] = masks[m] if time_first else masks[m].transpose(0, 1)
+            m_padded[nan_mask] = 0.0
         batch[m] = m_padded if time_first else m_padded.transpose(0, 1)
     mask = len_to_mask(lengths, time_first)
+    if obs_masks:
+        return batch, mask, lengths, order, masks
     return batch, mask, lengths, order
 
+def seq_collate_masks(data, time_first=True):
+    """Collate that returns zero-filled batch tensors and observation masks.
+    See seq_collate_dict for details."""
+    return seq_collate_dict(data, time_first, obs_masks=True)
+
 def seq_decoll(batch, lengths, order, time_first=True):
     """Decollate batched data by de-padding and reordering."""
     if type(batch) is tuple:
@@ -417,30 +809,100 @@ def func_delete(batch_in, del_func, lengths=None, modalities=None):
             batch_out[m][del_idx, b] = float('nan')
     return batch_out
 
-def rand_delete(batch_in, del_frac, lengths=None, modalities=None):
-    """Introduce random memoryless errors / deletions into a data batch"""
-    def del_func(length):
-        return np.random.choice(length, int(del_frac * length), False)
-    return func_delete(batch_in, del_func, lengths, modalities)
+def mask_delete(batch_in, mask_func, lengths=None, modalities=None,
+                shared=False, masks=None):
+    """Use mask_func to compute a (T, B) deletion mask for the whole batch,
+    then delete masked timesteps. Assumes time_first.
+
+    mask_func -- takes (t_max, lengths, device) and returns mask tensor
+    shared -- if true, use the same mask for all modalities
+    masks -- observation masks for each modality (see seq_collate_masks),
+             if provided, deleted timesteps are unset in a copy of masks
+             which is returned instead, leaving the batch data untouched
+    """
+    if modalities == None:
+        modalities = list(batch_in.keys())
+    batch_out = dict()
+    mask = None
+    for m in batch_in.keys():
+        if m not in modalities:
+            if masks is not None:
+                batch_out[m] = masks[m].clone()
+            else:
+                batch_out[m] = batch_in[m].clone().detach()
+            continue
+        t_max, b_dim = batch_in[m].shape[:2]
+        if lengths == None:
+            lengths = [t_max] * b_dim
+        if mask is None or not shared:
+            mask = mask_func(t_max, lengths, batch_in[m].device)
+        if masks is not None:
+            batch_out[m] = masks[m].masked_fill(mask, 0)
+            continue
+        # Broadcast mask across feature dimensions
+        mask_m = mask.view(t_max, b_dim, *([1] * (batch_in[m].dim()-2)))
+        batch_out[m] = batch_in[m].detach().masked_fill(mask_m, float('nan'))
+    return batch_out
 
-def burst_delete(batch_in, burst_frac, lengths=None, modalities=None):
-    """Introduce random burst errors / deletions into a data batch"""
-    def del_func(length):
-        t_start = np.random.randint(length)
-        t_stop = min(t_start + int(burst_frac * length), length)
-        return list(range(t_start, t_stop))
-    return func_delete(batch_in, del_func, lengths, modalities)
+def time_grid(t_max, lengths, device=None):
+    """Return (T, 1) time indices and (1, B) lengths for mask arithmetic."""
+    t_idx = torch.arange(t_max, device=device).unsqueeze(1)
+    lengths = torch.tensor(lengths, device=device).unsqueeze(0)
+    return t_idx, lengths
 
-def keep_segment(batch_in, f_start, f_stop, lengths=None, modalities=None):
+def rand_delete(batch_in, del_frac, lengths=None, modalities=None,
+                shared=False, masks=None):
+    """Introduce random memoryless errors / deletions into a data batch"""
+    def mask_func(t_max, lengths, device):
+        t_idx, t_len = time_grid(t_max, lengths, device)
+        n_del = torch.tensor([int(del_frac * l) for l in lengths],
+                             device=device).unsqueeze(0)
+        # Delete the n_del timesteps with lowest random scores, where
+        # padded timesteps have the highest scores
+        scores = torch.rand(t_max, len(lengths), device=device)
+        scores = scores.masked_fill(t_idx >= t_len, 2.0)
+        ranks = scores.argsort(dim=0).argsort(dim=0)
+        return ranks < n_del
+    return mask_delete(batch_in, mask_func, lengths, modalities,
+                       shared, masks)
+
+def burst_delete(batch_in, burst_frac, lengths=None, modalities=None,
+                 shared=False, masks=None):
+    """Introduce random burst errors / deletions into a data batch"""
+    def mask_func(t_max, lengths, device):
+        t_idx, t_len = time_grid(t_max, lengths, device)
+        n_del = torch.tensor([int(burst_frac * l) for l in lengths],
+                             device=device).unsqueeze(0)
+        t_start = (torch.rand(t_len.shape, device=device) *
+                   t_len.float()).long()
+        t_start = torch.min(t_start, t_len - 1)
+        t_stop = torch.min(t_start + n_del, t_len)
+        return (t_idx >= t_start) & (t_idx < t_stop)
+    return mask_delete(batch_in, mask_func, lengths, modalities,
+                       shared, masks)
+
+def keep_segment(batch_in, f_start, f_stop, lengths=None, modalities=None,
+                 shared=False, masks=None):
     """Delete all data outside of specified time fraction [f_start, f_stop)."""
-    def del_func(length):
-        t_start, t_stop = int(f_start * length), int(f_stop * length)
-        return list(range(0, t_start)) + list(range(t_stop, length))
-    return func_delete(batch_in, del_func, lengths, modalities)
-
-def del_segment(batch_in, f_start, f_stop, lengths=None, modalities=None):
+    def mask_func(t_max, lengths, device):
+        t_idx, t_len = time_grid(t_max, lengths, device)
+        t_start, t_stop = segment_extent(f_start, f_stop, lengths, device)
+        return ((t_idx < t_start) | (t_idx >= t_stop)) & (t_idx < t_len)
+    return mask_delete(batch_in, mask_func, lengths, modalities,
+                       shared, masks)
+
+def del_segment(batch_in, f_start, f_stop, lengths=None, modalities=None,
+                shared=False, masks=None):
     """Delete specified time fraction [f_start, f_stop)."""
-    def del_func(length):
-        t_start, t_stop = int(f_start * length), int(f_stop * length)
-        return list(range(t_start, t_stop))
-    return func_delete(batch_in, del_func, lengths, modalities)
+    def mask_func(t_max, lengths, device):
+        t_idx, _ = time_grid(t_max, lengths, device)
+        t_start, t_stop = segment_extent(f_start, f_stop, lengths, device)
+        return (t_idx >= t_start) & (t_idx < t_stop)
+    return mask_delete(batch_in, mask_func, lengths, modalities,
+                       shared, masks)
+
+def segment_extent(f_start, f_stop, lengths, device=None):
+    """Return (1, B) start and stop indices given time fractions."""
+    t_start = torch.tensor([int(f_start * l) for l in lengths], device=device)
+    t_stop = torch.tensor([int(f_stop * l) for l in lengths], device=device)
+    return t_start.unsqueeze(0), t_stop.unsqueeze(0)
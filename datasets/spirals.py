@@ -18,7 +18,8 @@ class SpiralsDataset(MultiseqDataset):
     """Dataset of noisy spirals."""
 
     def __init__(self, modalities, base_dir, subset,
-                 truncate=False, item_as_dict=False):
+                 truncate=False, item_as_dict=False, dtypes=None,
+                 keep_orig=True, num_workers=0, cache_dir=None):
         # Generate dataset if it doesn't exist yet
         subset_dir = os.path.join(base_dir, subset)
         if not os.path.exists(subset_dir):
@@ -42,7 +43,9 @@ class SpiralsDataset(MultiseqDataset):
         super(SpiralsDataset, self).__init__(
             modalities, dirs, regex,
             [preprocess[m] for m in modalities],
-            rates, base_rate, truncate, [], item_as_dict)
+            rates, base_rate, truncate, [], item_as_dict, dtypes=dtypes,
+            keep_orig=keep_orig, num_workers=num_workers,
+            cache_dir=cache_dir)
 
 def gen_spiral(start_r, stop_r, start_theta, stop_theta,
                aspect_ratio=1, timesteps=100):
@@ -24,7 +24,9 @@ subjects = [
 
 class VidTIMITDataset(MultiseqDataset):
     """VidTIMIT audio/video dataset."""
-    def __init__(self, data_dir, base_rate=None, item_as_dict=False):
+    def __init__(self, data_dir, base_rate=None, item_as_dict=False,
+                 dtypes=None, keep_orig=True, lazy=False, num_workers=0,
+                 cache_dir=None):
         # Generate dataset if it doesn't exist yet
         audio_dir = os.path.join(data_dir, 'audio')
         video_dir = os.path.join(data_dir, 'video')
@@ -39,7 +41,9 @@ class VidTIMITDataset(MultiseqDataset):
             modalities=['audio', 'video'], dirs=[audio_dir, video_dir],
             regex="(\w+)_(\w+)\.npy", preprocess=None,
             rates=fps, base_rate=base_rate, truncate=True,
-            ids_as_mods=[], item_as_dict=item_as_dict)
+            ids_as_mods=[], item_as_dict=item_as_dict,
+            dtypes=dtypes, keep_orig=keep_orig, lazy=lazy,
+            num_workers=num_workers, cache_dir=cache_dir)
 
 def download_vidTIMIT(dest='./vidTIMIT'):
     """Downloads and preprocesses VidTIMIT dataset."""
@@ -25,7 +25,9 @@ duplicates = ['lena_walk', 'lena_run', 'lena_skip']
 
 class WeizmannDataset(MultiseqDataset):
     """Weizmann human action video dataset."""
-    def __init__(self, data_dir, base_rate=None, item_as_dict=False):
+    def __init__(self, data_dir, base_rate=None, item_as_dict=False,
+                 dtypes=None, keep_orig=True, lazy=False, num_workers=0,
+                 cache_dir=None):
         # Generate dataset if it doesn't exist yet
         if (not os.path.exists(data_dir) or
             len([f for f in os.listdir(data_dir) if f[-3:] == 'npy']) == 0):
@@ -35,7 +37,9 @@ class WeizmannDataset(MultiseqDataset):
             regex=["([^_\W]+)_([^_\W]+)\.npy",
                    "([^_\W]+)_([^_\W]+)_mask\.npy"],
             preprocess=None, rates=25, base_rate=base_rate, truncate=False,
-            ids_as_mods=['person', 'action'], item_as_dict=item_as_dict)
+            ids_as_mods=['person', 'action'], item_as_dict=item_as_dict,
+            dtypes=dtypes, keep_orig=keep_orig, lazy=lazy,
+            num_workers=num_workers, cache_dir=cache_dir)
 
 def download_weizmann(dest='./weizmann'):
     """Downloads and preprocesses Weizmann human action dataset."""
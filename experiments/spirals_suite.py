@@ -53,6 +53,8 @@ def run(args):
     # Set up trial configuration
     config = {
         "data_dir": data_dir,
+        # Cache loaded datasets so that each trial reads a single file
+        "cache_dir": os.path.join(data_dir, 'cache'),
         # Set low learning rate to prevent NaNs
         "lr": 5e-3,
         # Repeat each configuration with different random seeds
@@ -53,6 +53,8 @@ def run(args):
     # Set up trial configuration
     config = {
         "data_dir": data_dir,
+        # Cache loaded datasets so that each trial reads a single file
+        "cache_dir": os.path.join(data_dir, 'cache'),
         "epochs" : 500,
         "kld_anneal" : 250,
         # Save less to consume less disk space
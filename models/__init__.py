@@ -1,6 +1,6 @@
 from __future__ import absolute_import
 from .vrnn import MultiVRNN
-from .dmm import MultiDMM
+from .dmm import MultiDMM, FilterState, SmootherState
 from .dks import MultiDKS
 
 names = {'vrnn': 'MultiVRNN', 'dmm': 'MultiDMM', 'dks': 'MultiDKS'}
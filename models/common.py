@@ -6,6 +6,29 @@ from builtins import range
 import torch
 import torch.nn as nn
 
+class StepBuffer(object):
+    """Collects per-timestep tensors of the same shape into a (T, ...) tensor.
+
+    When gradients are disabled, tensors are written into a buffer that is
+    preallocated on the first write, avoiding a copy when stacking. With
+    autograd, each in-place write would copy the full gradient of the
+    buffer in the backward pass, so tensors are stacked at the end instead.
+    """
+    def __init__(self, t_max):
+        self.t_max = t_max
+        self.data = [None] * t_max if torch.is_grad_enabled() else None
+
+    def __setitem__(self, t, x):
+        if self.data is None:
+            self.data = x.new_empty((self.t_max,) + tuple(x.shape))
+        self.data[t] = x
+
+    def stack(self):
+        """Returns the (T, ...) tensor of all timesteps."""
+        if type(self.data) is list:
+            return torch.stack(self.data)
+        return self.data
+
 class CategoricalMLP(nn.Module):
     """MLP from input to categorical output."""
     def __init__(self, in_dim, out_dim, h_dim):
@@ -40,6 +63,22 @@ class GaussianMLP(nn.Module):
         mean, std = self.h_to_mean(h), (self.h_to_std(h) + self.min_std)
         return mean, std
 
+    def project(self, x, start=0, stop=None, bias=True):
+        """Partial pre-activation of the first layer, using only the
+        input features in [start, stop). Partial projections of disjoint
+        slices of the input can be summed and passed to from_pre."""
+        lin = self.in_to_h[0]
+        weight = lin.weight[:, start:stop]
+        if bias and lin.bias is not None:
+            return nn.functional.linear(x, weight, lin.bias)
+        return nn.functional.linear(x, weight)
+
+    def from_pre(self, pre):
+        """Output parameters given pre-activation of the first layer."""
+        h = self.in_to_h[1](pre)
+        mean, std = self.h_to_mean(h), (self.h_to_std(h) + self.min_std)
+        return mean, std
+
 class GaussianGTF(nn.Module):
     """GRU-like latent space gated transition function (GTF)."""
     def __init__(self, z_dim, h_dim, min_std=0):
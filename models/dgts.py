@@ -36,20 +36,60 @@ class MultiDGTS(nn.Module):
         product_std : torch.tensor
             std of product Gaussian, shape (T, B, D) or (B, D)
         """
-        # Square std and add numerical constant for stability
-        var = std.pow(2) + eps
-        # Precision matrix of i-th Gaussian expert (T = 1/sigma^2)
-        T = 1. / var
         # Set missing data to zero so they are excluded from calculation
         if mask is None:
-            mask = 1 - torch.isnan(var).any(dim=-1)
-        T = T * mask.float().unsqueeze(-1)
-        mean = mean * mask.float().unsqueeze(-1)
-        product_mean = torch.sum(mean * T, dim=0) / torch.sum(T, dim=0)
+            mask = 1 - torch.isnan(std).any(dim=-1)
+        # Sum natural parameters across experts, then convert back
+        prec, wmean = self.to_natural(mean, std, mask, eps)
+        product_mean, product_std = \
+            self.from_natural(torch.sum(prec, dim=0), torch.sum(wmean, dim=0))
         product_mean[torch.isnan(product_mean)] = 0.0
-        product_std = (1. / torch.sum(T, dim=0)).pow(0.5)
         return product_mean, product_std
 
+    def to_natural(self, mean, std, mask=None, eps=1e-8):
+        """
+        Return natural parameters of independent Gaussian experts.
+
+        The product of experts corresponds to the sum of the natural
+        parameters, so these can be computed once and combined by addition.
+
+        Parameters
+        ----------
+        mean : torch.tensor
+            (..., D) for D latent dims
+        std : torch.tensor
+            (..., D) for D latent dims
+        mask : torch.tensor
+            (...) optional mask, masked out experts have zero parameters
+
+        Returns
+        -------
+        prec : torch.tensor
+            precision (i.e. 1/sigma^2) of each expert, same shape as std
+        wmean : torch.tensor
+            precision-weighted mean of each expert, same shape as mean
+        """
+        # Square std and add numerical constant for stability
+        prec = 1. / (std.pow(2) + eps)
+        if mask is not None:
+            prec = prec * mask.float().unsqueeze(-1)
+        wmean = mean * prec
+        return prec, wmean
+
+    def from_natural(self, prec, wmean):
+        """Return mean and std given precision and precision-weighted mean."""
+        return wmean / prec, prec.pow(-0.5)
+
+    def scripted(self, name, build):
+        """Returns the scripted version of the module returned by build,
+        scripting it on first use. Scripted modules share parameters with
+        the eager ones and are cached outside the module tree, so state
+        dicts and optimizers are unaffected. Requires pytorch >= 1.2."""
+        cache = self.__dict__.setdefault('_scripted', dict())
+        if name not in cache:
+            cache[name] = torch.jit.script(build())
+        return cache[name]
+
     def mean_of_experts(self, mean, std, mask=None):
         """
 
@@ -102,6 +142,14 @@ class MultiDGTS(nn.Module):
            otherwise targets is a copy of inputs by default
         uni_loss : bool
            flag to compute ELBO for each modality on its own (default : True)
+        fused : bool
+           stack the modality subsets along the batch dimension and compute
+           their ELBOs in a single forward pass (default : False)
+        masks : dict of str : torch.tensor
+           optional (T, B) observation masks for each input modality,
+           in which case inputs are assumed to be zero-filled (not NaN)
+        target_masks : dict of str : torch.tensor
+           optional (T, B) observation masks for each target modality
 
         Returns
         -------
@@ -114,27 +162,80 @@ class MultiDGTS(nn.Module):
         # If targets not provided, assume inputs are targets
         if targets == None:
             targets = inputs
-        loss = 0
         # Compute negative ELBO loss for all modalities
+        subsets = []
         if len(self.modalities) > 1:
-            infer, prior, recon = self.forward(inputs, **kwargs)
-            loss += self.loss(targets, infer, prior, recon, mask,
-                              kld_mult, rec_mults)
-        if not uni_loss:
-            return loss
+            subsets.append(list(inputs.keys()))
         # Compute negative ELBO loss for individual modalities
-        for m in self.modalities:
-            infer, prior, recon = self.forward({m : inputs[m]}, **kwargs)
-            loss += self.loss({m : targets[m]}, infer, prior, recon, mask,
-                              kld_mult, rec_mults)
+        if uni_loss:
+            subsets += [[m] for m in self.modalities]
+        if kwargs.get('fused', False) and len(subsets) > 1:
+            return self.fused_step(inputs, mask, kld_mult, rec_mults,
+                                   targets, subsets, **kwargs)
+        loss = 0
+        for s in subsets:
+            infer, prior, recon = self.forward({m : inputs[m] for m in s},
+                                               **kwargs)
+            loss += self.loss({m : targets[m] for m in s if m in targets},
+                              infer, prior, recon, mask, kld_mult, rec_mults,
+                              obs_masks=kwargs.get('target_masks'))
         return loss
+
+    def fused_step(self, inputs, mask, kld_mult, rec_mults,
+                   targets, subsets, **kwargs):
+        """Computes the summed negative ELBO across modality subsets
+        using a single forward pass over an enlarged batch.
+
+        Each subset is a copy of the batch where modalities outside the
+        subset are treated as missing (i.e. set to NaN), which all models
+        handle identically to absent modalities. The loss matches the
+        sum of the per-subset losses, up to sampling noise and batch norm
+        statistics, while avoiding one forward pass per subset.
+        """
+        n_sets = len(subsets)
+        targets = {m : targets[m] for m in targets if m in self.modalities}
+        t_masks = kwargs.get('target_masks')
+        inputs, kwargs = self.stack_inputs(inputs, subsets, kwargs)
+        if t_masks is None:
+            targets = self.stack_subsets(targets, subsets)
+        else:
+            # Delete targets by masking rather than NaN-filling
+            targets = self.stack_subsets(targets, subsets, fill=0)
+            t_masks = self.stack_subsets(t_masks, subsets, fill=0)
+        mask = mask.repeat(1, n_sets, *([1] * (mask.dim()-2)))
+        kwargs['lengths'] = list(kwargs['lengths']) * n_sets
+        infer, prior, recon = self.forward(inputs, **kwargs)
+        loss = self.loss(targets, infer, prior, recon, mask,
+                         kld_mult, rec_mults, obs_masks=t_masks)
+        return loss
+
+    def stack_inputs(self, inputs, subsets, kwargs):
+        """Stacks inputs and any input-dependent forward arguments
+        across modality subsets for use by fused_step."""
+        if kwargs.get('masks') is None:
+            return self.stack_subsets(inputs, subsets), kwargs
+        # Delete inputs by masking rather than NaN-filling
+        masks = {m : kwargs['masks'][m] for m in inputs}
+        masks = self.stack_subsets(masks, subsets, fill=0)
+        inputs = self.stack_subsets(inputs, subsets, fill=0)
+        return inputs, dict(kwargs, masks=masks)
+
+    def stack_subsets(self, inputs, subsets, fill=float('nan')):
+        """Stacks copies of inputs along the batch dimension, deleting
+        (i.e. filling) modalities not in the corresponding subset."""
+        stacked = dict()
+        for m in inputs:
+            missing = torch.full_like(inputs[m], fill)
+            stacked[m] = torch.cat([inputs[m] if m in s else missing
+                                    for s in subsets], dim=1)
+        return stacked
         
     def loss(self, inputs, infer, prior, recon, mask=1,
-             kld_mult=1.0, rec_mults={}, avg=False):
+             kld_mult=1.0, rec_mults={}, avg=False, obs_masks=None):
         """Computes weighted sum of KLD loss and reconstruction loss."""
         loss = 0.0
         loss += kld_mult * self.kld_loss(infer, prior, mask)
-        loss += self.rec_loss(inputs, recon, mask, rec_mults)
+        loss += self.rec_loss(inputs, recon, mask, rec_mults, obs_masks)
         if avg:
             if type(mask) is torch.Tensor:
                 n_data = torch.sum(mask)
@@ -151,8 +252,10 @@ class MultiDGTS(nn.Module):
         return losses.kld_gauss(infer_mean, infer_std,
                                 prior_mean, prior_std, mask)
 
-    def rec_loss(self, inputs, recon, mask=None, rec_mults={}):
-        """Input reconstruction loss."""
+    def rec_loss(self, inputs, recon, mask=None, rec_mults={},
+                 obs_masks=None):
+        """Input reconstruction loss, where obs_masks are optional
+        observation masks for zero-filled (instead of NaN) inputs."""
         loss = 0.0
         for m in self.modalities:
             if m not in inputs:
@@ -160,18 +263,23 @@ class MultiDGTS(nn.Module):
             mult = 1.0 if m not in rec_mults else rec_mults[m]
             if mult == 0:
                 continue
+            mask_m, check_nan = mask, True
+            if obs_masks is not None and m in obs_masks:
+                mask_m, check_nan = obs_masks[m], False
+                if mask is not None:
+                    mask_m = mask_m * mask.view(*mask_m.shape)
             if self.dists[m] == 'Bernoulli':
                 rec_prob = recon[m][0]
-                loss += mult * losses.nll_bernoulli(rec_prob,
-                                                    inputs[m], mask)
+                loss += mult * losses.nll_bernoulli(rec_prob, inputs[m],
+                                                    mask_m, check_nan)
             elif self.dists[m] == 'Categorical':
                 rec_probs = recon[m][0]
-                loss += mult * losses.nll_categorical(rec_probs,
-                                                      inputs[m], mask)
+                loss += mult * losses.nll_categorical(rec_probs, inputs[m],
+                                                      mask_m, check_nan)
             elif self.dists[m] == 'Normal':
                 rec_mean, rec_std = recon[m]
-                loss += mult * losses.nll_gauss(rec_mean, rec_std,
-                                                inputs[m], mask)
+                loss += mult * losses.nll_gauss(rec_mean, rec_std, inputs[m],
+                                                mask_m, check_nan)
         return loss
             
     def _sample_gauss(self, mean, std):
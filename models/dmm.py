@@ -17,6 +17,7 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 from builtins import zip, range
+from collections import namedtuple, deque
 
 import numpy as np
 import torch
@@ -25,10 +26,105 @@ import torch.nn as nn
 from . import common, losses
 from .dgts import MultiDGTS
 
+# State of online forward filtering after t observed frames
+# prior_mean, prior_std : parameters of p(z_t|z_{t-1}) for the next frame
+# infer_mean, infer_std : parameters of q(z_{t-1}|z_{t-2}, x_{t-1})
+# z : sample (or mean) of z_{t-1}, used to reconstruct the last frame
+FilterState = namedtuple('FilterState', ['t', 'prior_mean', 'prior_std',
+                                         'infer_mean', 'infer_std', 'z'])
+
+# State of online fixed-lag smoothing
+# lag : number of frames L to look ahead before emitting an estimate
+# obs : ring buffer of natural parameters for the last (up to) L+1 frames
+# fwd : FilterState of the forward smoothing pass
+SmootherState = namedtuple('SmootherState', ['lag', 'obs', 'fwd'])
+
+class NaturalFilter(nn.Module):
+    """Filtering recursion of MultiDMM.z_filter_natural for one direction,
+    written so that it can be compiled by TorchScript. Mirrors the eager
+    product of experts, particle propagation and moment merging."""
+    def __init__(self, trans):
+        super(NaturalFilter, self).__init__()
+        self.trans = trans
+
+    def forward(self, obs_prec, obs_wmean, glb_mean, glb_std, reverse,
+                sample, n_particles, sample_init, particle_chunk, eps):
+        # type: (Tensor, Tensor, Tensor, Tensor, bool, bool, int, bool, int, float) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor]
+        t_max = obs_prec.shape[0]
+        if particle_chunk <= 0:
+            particle_chunk = n_particles
+        glb_prec = 1. / (glb_std.pow(2) + 1e-8)
+        glb_wmean = glb_mean * glb_prec
+        prior_mean, prior_std = [], []
+        infer_mean, infer_std = [], []
+        samples = []
+        nxt_mean, nxt_std = glb_mean, glb_std
+        for i in range(t_max):
+            t = t_max - 1 - i if reverse else i
+            # Use global prior at the first step, p(z|z_prev) afterwards
+            prior_mean_t, prior_std_t = nxt_mean, nxt_std
+            prior_mean.append(prior_mean_t)
+            prior_std.append(prior_std_t)
+
+            # Combine prior with inferred distributions (product of experts)
+            prec = 1. / (prior_std_t.pow(2) + eps)
+            wmean = prior_mean_t * prec + obs_wmean[t]
+            prec = prec + obs_prec[t]
+            infer_mean_t, infer_std_t = wmean / prec, prec.pow(-0.5)
+            infer_mean.append(infer_mean_t)
+            infer_std.append(infer_std_t)
+
+            last = (i == t_max - 1)
+            if sample or n_particles > 1 or (i == 0 and sample_init):
+                # Sample all particles at once, like MultiDMM.z_propagate
+                k_max, k_chunk = n_particles, particle_chunk
+                shape = [n_particles] + list(infer_std_t.shape)
+                z = torch.randn(shape).to(infer_std_t.device)
+                z = z * infer_std_t + infer_mean_t
+                samples.append(z.mean(dim=0))
+            else:
+                k_max, k_chunk = 1, 1
+                z = infer_mean_t.unsqueeze(0)
+                samples.append(infer_mean_t)
+            if last:
+                continue
+
+            # Compute p(z_next|z), merging moments across particle chunks
+            # (initial values only fix the types, the first chunk sets them)
+            mix_mean, mix_m2 = glb_mean, glb_std
+            for k in range(0, k_max, k_chunk):
+                n_k = min(k_chunk, k_max - k)
+                z_k = z[k:k+n_k]
+                q_mean, q_std = self.trans(z_k.reshape(-1, z_k.shape[-1]))
+                q_prec = 1. / (q_std.reshape(z_k.shape).pow(2) + 1e-8)
+                q_wmean = q_mean.reshape(z_k.shape) * q_prec
+                var_k = 1. / (q_prec + glb_prec)
+                mean_k = (q_wmean + glb_wmean) * var_k
+                c_mean = mean_k.mean(dim=0)
+                c_m2 = (var_k + (mean_k - c_mean).pow(2)).sum(dim=0)
+                if k == 0:
+                    mix_mean, mix_m2 = c_mean, c_m2
+                else:
+                    delta = c_mean - mix_mean
+                    mix_mean = mix_mean + delta * (n_k / (k + n_k))
+                    mix_m2 = (mix_m2 + c_m2 +
+                              delta.pow(2) * (k * n_k / (k + n_k)))
+            nxt_mean, nxt_std = mix_mean, (mix_m2 / k_max).pow(0.5)
+
+        if reverse:
+            prior_mean.reverse()
+            prior_std.reverse()
+            infer_mean.reverse()
+            infer_std.reverse()
+            samples.reverse()
+        return (torch.stack(infer_mean), torch.stack(infer_std),
+                torch.stack(prior_mean), torch.stack(prior_std),
+                torch.stack(samples))
+
 class MultiDMM(MultiDGTS):
     def __init__(self, modalities, dims, dists=None,
                  encoders=None, decoders=None, h_dim=32, z_dim=32,
-                 z0_mean=0.0, z0_std=1.0, min_std=1e-3,
+                 z0_mean=0.0, z0_std=1.0, min_std=1e-3, jit=False,
                  device=torch.device('cuda:0')):
         """
         Construct multimodal deep Markov model.
@@ -55,6 +151,9 @@ class MultiDMM(MultiDGTS):
             standard deviation of global latent prior
         min_std : float
             minimum std to ensure stable training
+        jit : bool
+            run the filtering recursion over timesteps as a TorchScript
+            loop (default : False, requires pytorch >= 1.2)
         device : torch.device
             device on which this module is stored (CPU or GPU)
         """
@@ -115,6 +214,7 @@ class MultiDMM(MultiDGTS):
         self.z0_mean = nn.Parameter(z0_mean * torch.ones(1, z_dim))
         self.z0_log_std = nn.Parameter((z0_std * torch.ones(1, z_dim)).log())
         self.min_std = min_std
+        self.jit = jit
 
         # Store module in specified device (CUDA/CPU)
         self.device = (device if torch.cuda.is_available() else
@@ -128,7 +228,7 @@ class MultiDMM(MultiDGTS):
         mask = torch.ones(shape[:-1], dtype=torch.uint8).to(self.device)
         return mean, std, mask
 
-    def encode(self, inputs, combine=False):
+    def encode(self, inputs, combine=False, natural=False, obs_masks=None):
         """Encode (optionally missing) inputs to latent space.
 
         Parameters
@@ -140,14 +240,23 @@ class MultiDMM(MultiDGTS):
         combine : bool
            if true, combines inferred Gaussian distributions using
            the product of experts formula
+        natural : bool
+           if true, returns natural parameters (precision and
+           precision-weighted mean) instead of mean and std,
+           with masked out experts set to zero
+        obs_masks : dict of str : torch.tensor
+           optional (T, B) observation masks for each modality,
+           in which case inputs are assumed to be zero-filled (not NaN)
 
         Returns
         -------
         z_mean : torch.tensor
             inferred latent mean for each modality
             shape is (M, T, B, D) if combine is False, otherwise (T, B, D)
+            replaced by precision if natural is True
         z_std : torch.tensor
             inferred latent std for each modality, same shape as z_mean
+            replaced by precision-weighted mean if natural is True
         masks : torch.tensor
             masks for batches and timepoints with missing inputs
             shape is (M, T, B) if combine is False, otherwise (T, B)
@@ -161,10 +270,14 @@ class MultiDMM(MultiDGTS):
             # Ignore missing modalities
             if m not in inputs:
                 continue
-            # Mask out all timesteps with NaNs
-            mask_m = 1 - torch.isnan(inputs[m]).flatten(2,-1).any(dim=-1)
-            input_m = inputs[m].clone().detach()
-            input_m[torch.isnan(input_m)] = 0.0
+            if obs_masks is not None and m in obs_masks:
+                # Use provided masks for zero-filled inputs
+                mask_m, input_m = obs_masks[m], inputs[m].detach()
+            else:
+                # Mask out all timesteps with NaNs
+                mask_m = 1 - torch.isnan(inputs[m]).flatten(2,-1).any(dim=-1)
+                input_m = inputs[m].clone().detach()
+                input_m[torch.isnan(input_m)] = 0.0
             if self.dists[m] == 'Categorical':
                 input_m = input_m.long()
             # Compute mean and std of latent z given modality m
@@ -180,6 +293,14 @@ class MultiDMM(MultiDGTS):
         z_std = torch.stack(z_std, dim=0)
         masks = torch.stack(masks, dim=0)
 
+        if natural:
+            # Convert to natural parameters, which combine by addition
+            z_prec, z_wmean = self.to_natural(z_mean, z_std, masks)
+            if combine:
+                z_prec, z_wmean = z_prec.sum(dim=0), z_wmean.sum(dim=0)
+                masks = masks.any(dim=0)
+            return z_prec, z_wmean, masks
+
         if combine:
             # Combine the Gaussian parameters using PoE
             z_mean, z_std = \
@@ -231,34 +352,95 @@ class MultiDMM(MultiDGTS):
             std of z_next, shape is (B, D)
         """
 
-        if glb_prior is None:
-            glb_mean, glb_std, _ = self.prior(z.shape[1:])
-        else:
-            glb_mean, glb_std = glb_prior
+        z_mean, z_var = self._z_next_particles(z, direction, glb_prior)
 
         if z.shape[0] == 1:
-            # Compute p(z|z_prev) = p(z) * q'(z|z_prev)
-            q_mean, q_std = self.trans[direction](z[0])
-            z_mean = torch.stack([glb_mean, q_mean])
-            z_std = torch.stack([glb_std, q_std])
-            z_mean, z_std = self.product_of_experts(z_mean, z_std)
+            return z_mean[0], z_var[0].pow(0.5)
 
-            return z_mean, z_std
+        # Average across particles, accumulating the mixture variance
+        # from the particle variances and squared deviations in one pass
+        mix_mean = z_mean.mean(dim=0)
+        mix_var = (z_var + (z_mean - mix_mean).pow(2)).mean(dim=0)
 
-        # Compute p(z|z_prev) for each particle
-        q_mean, q_std = self.trans[direction](z.view(-1, self.z_dim))
-        z_mean = torch.stack([glb_mean.repeat(z.shape[0], 1), q_mean])
-        z_std = torch.stack([glb_std.repeat(z.shape[0], 1), q_std])
-        z_mean, z_std = self.product_of_experts(z_mean, z_std)
+        return mix_mean, mix_var.pow(0.5)
+
+    def z_propagate(self, mean, std, direction='fwd', glb_prior=None,
+                    n_particles=1, particle_chunk=None, propagate=True):
+        """Sample particles from N(mean, std) and compute p(z_next|z),
+        streaming the particles through the transition in chunks.
 
-        # Reshape and average across particles
-        z_mean, z_std = z_mean.view(*z.shape), z_std.view(*z.shape)
-        z_mean, z_std = self.mean_of_experts(z_mean, z_std)
+        Parameters
+        ----------
+        mean : torch.tensor
+           mean of current latent distribution, shape is (B, D)
+        std : torch.tensor
+           std of current latent distribution, shape is (B, D)
+        direction : {'fwd', 'bwd'}
+           which direction to compute
+        glb_prior : (torch.tensor, torch.tensor)
+           optionally provide prior parameters to reuse
+        n_particles : int
+           number of particles to sample
+        particle_chunk : int
+           max. particles per transition call (default : all)
+        propagate : bool
+           whether to compute p(z_next|z), otherwise only sample
 
-        return z_mean, z_std
+        Returns
+        -------
+        z_mean : torch.tensor
+            mean of sampled particles, shape is (B, D)
+        nxt_mean : torch.tensor
+            mean of z_next, shape is (B, D), None if propagate is False
+        nxt_std : torch.tensor
+            std of z_next, shape is (B, D), None if propagate is False
+        """
+        if particle_chunk is None or particle_chunk <= 0:
+            particle_chunk = n_particles
+        # Sample all particles at once so that chunking does not change
+        # the random stream, and only split the transition evaluation
+        z = self._sample_gauss(mean.expand(n_particles, -1, -1),
+                               std.expand(n_particles, -1, -1))
+        if not propagate:
+            return z.mean(dim=0), None, None
+        nxt_mean, nxt_m2 = None, None
+        for k in range(0, n_particles, particle_chunk):
+            n_k = min(particle_chunk, n_particles - k)
+            z_k = z[k:k+n_k]
+            # Compute moments of p(z_next|z) for this chunk of particles
+            mean_k, var_k = self._z_next_particles(z_k, direction, glb_prior)
+            c_mean = mean_k.mean(dim=0)
+            c_m2 = (var_k + (mean_k - c_mean).pow(2)).sum(dim=0)
+            if nxt_mean is None:
+                nxt_mean, nxt_m2 = c_mean, c_m2
+                continue
+            # Merge with moments of previous chunks (Chan et al.)
+            delta = c_mean - nxt_mean
+            nxt_mean = nxt_mean + delta * (n_k / (k + n_k))
+            nxt_m2 = nxt_m2 + c_m2 + delta.pow(2) * (k * n_k / (k + n_k))
+        nxt_std = (nxt_m2 / n_particles).pow(0.5)
+        return z.mean(dim=0), nxt_mean, nxt_std
+
+    def _z_next_particles(self, z, direction='fwd', glb_prior=None):
+        """Compute mean and variance of p(z_next|z) for each particle."""
+        if glb_prior is None:
+            glb_mean, glb_std, _ = self.prior((1, 1))
+        else:
+            glb_mean, glb_std = glb_prior
 
-    def z_sample(self, t_max, b_dim, direction='fwd',
-                 sample=True, n_particles=1, z_init=None, inclusive=False):
+        # Compute p(z|z_prev) = p(z) * q'(z|z_prev) for each particle,
+        # broadcasting the global prior across particles
+        q_mean, q_std = self.trans[direction](z.view(-1, self.z_dim))
+        q_prec, q_wmean = self.to_natural(q_mean.view(*z.shape),
+                                          q_std.view(*z.shape))
+        glb_prec, glb_wmean = self.to_natural(glb_mean, glb_std)
+        z_var = 1. / (q_prec + glb_prec)
+        z_mean = (q_wmean + glb_wmean) * z_var
+        return z_mean, z_var
+
+    def z_sample(self, t_max, b_dim, direction='fwd', sample=True,
+                 n_particles=1, z_init=None, inclusive=False,
+                 particle_chunk=None):
         """Generates a sequence of latent variables.
 
         Parameters
@@ -277,6 +459,8 @@ class MultiDMM(MultiDGTS):
             (mean, std) of initial latent distribution (default: global prior)
         inclusive : bool
             flag to include initial state in returned tensor (default : False)
+        particle_chunk : int
+            max. number of particles to process at once (default : all)
 
         Returns
         -------
@@ -286,38 +470,35 @@ class MultiDMM(MultiDGTS):
             std of z_next, shape is (T, B, D) for D latent dims
         """
         glb_mean, glb_std, _ = self.prior((b_dim, 1))
-        z_mean, z_std = [], []
+        z_mean, z_std = common.StepBuffer(t_max), common.StepBuffer(t_max)
+
+        # Fill in reverse time order if direction is backward
+        t_rng = list(range(t_max))
+        if direction == 'bwd':
+            t_rng.reverse()
 
         # Initialize latent distribution
         z_mean_t, z_std_t = glb_mean, glb_std if z_init is None else z_init
         if inclusive:
-            z_mean.append(z_mean_t)
-            z_std.append(z_std_t)
+            z_mean[t_rng[0]], z_std[t_rng[0]] = z_mean_t, z_std_t
+            t_rng = t_rng[1:]
 
-        for t in range(t_max - int(inclusive)):
-            # Sample particles for current timestep
+        for t in t_rng:
+            # Sample particles and compute parameters for next time step
             if sample or n_particles > 1:
-                z_t = self._sample_gauss(
-                    z_mean_t.expand(n_particles, -1, -1),
-                    z_std_t.expand(n_particles, -1, -1))
+                _, z_mean_t, z_std_t =\
+                    self.z_propagate(z_mean_t, z_std_t, direction,
+                                     (glb_mean, glb_std), n_particles,
+                                     particle_chunk)
             else:
-                z_t = z_mean_t.unsqueeze(0)
-
-            # Compute parameters for next time step
-            z_mean_t, z_std_t =\
-                self.z_next(z_t, direction, (glb_mean, glb_std))
-            z_mean.append(z_mean_t)
-            z_std.append(z_std_t)
-
-        if direction == 'bwd':
-            z_mean.reverse()
-            z_std.reverse()
-        z_mean, z_std = torch.stack(z_mean), torch.stack(z_std)
+                z_mean_t, z_std_t = self.z_next(z_mean_t.unsqueeze(0),
+                                                direction, (glb_mean, glb_std))
+            z_mean[t], z_std[t] = z_mean_t, z_std_t
 
-        return z_mean, z_std
+        return z_mean.stack(), z_std.stack()
 
-    def z_filter(self, z_mean, z_std, z_masks, direction='fwd',
-                 sample=True, n_particles=1, sample_init=False):
+    def z_filter(self, z_mean, z_std, z_masks, direction='fwd', sample=True,
+                 n_particles=1, sample_init=False, particle_chunk=None):
         """Performs filtering on the latent variables by combining
         the prior distributions with inferred distributions
         at each time step using a product of Gaussian experts.
@@ -339,6 +520,8 @@ class MultiDMM(MultiDGTS):
             number of filtering particles, overrides sample flag if > 1
         sample_init : bool
             whether to sample for initial time-step
+        particle_chunk : int
+            max. number of particles to process at once (default : all)
 
         Returns
         -------
@@ -356,60 +539,272 @@ class MultiDMM(MultiDGTS):
             z samples from time-wise cond. posterior, shope is (T, B, D)
             returns mean for each time step when n_particles > 1 are sampled
         """
-        t_max, b_dim = z_mean[0].shape[:2]
+        # Precompute the summed precisions and precision-weighted means
+        # of the inferred experts for all timesteps at once, so that only
+        # the prior p(z_t|z_prev) has to be combined inside the loop
+        obs_prec, obs_wmean = self.to_natural(z_mean, z_std, z_masks)
+        obs_prec, obs_wmean = obs_prec.sum(dim=0), obs_wmean.sum(dim=0)
+        return self.z_filter_natural(obs_prec, obs_wmean, direction, sample,
+                                     n_particles, sample_init, particle_chunk)
+
+    def z_filter_natural(self, obs_prec, obs_wmean, direction='fwd',
+                         sample=True, n_particles=1, sample_init=False,
+                         particle_chunk=None, eps=1e-8):
+        """Performs filtering given the natural parameters of the
+        inferred distributions, already summed across experts.
+        See :func:`~models.MultiDMM.z_filter` for other arguments.
 
-        # Initialize list accumulators
-        prior_mean, prior_std = [], []
-        infer_mean, infer_std = [], []
-        samples = []
-
-        # Reverse inputs in time if direction is backward
-        rv = ( (lambda x : list(reversed(x))) if direction == 'bwd'
-               else (lambda x : x) )
+        Parameters
+        ----------
+        obs_prec : torch.tensor
+            summed precisions of inferred distributions, shape (T, B, D)
+        obs_wmean : torch.tensor
+            summed precision-weighted means, shape (T, B, D)
+        """
+        t_max, b_dim = obs_prec.shape[:2]
 
         # Setup global (i.e. time-invariant) prior on z
         glb_mean, glb_std, _ = self.prior((b_dim, 1))
 
-        for t in rv(list(range(t_max))):
-            prior_mask_t =\
-                torch.ones((b_dim,), dtype=torch.uint8).to(self.device)
-            if len(samples) == 0:
+        if self.jit:
+            # Run the whole recursion as a single scripted loop
+            loop = self.scripted('filter_' + direction, lambda:
+                                 NaturalFilter(self.trans[direction]))
+            infer_mean, infer_std, prior_mean, prior_std, samples =\
+                loop(obs_prec, obs_wmean, glb_mean, glb_std,
+                     direction == 'bwd', bool(sample), n_particles,
+                     bool(sample_init), particle_chunk or 0, eps)
+            return (infer_mean, infer_std), (prior_mean, prior_std), samples
+
+        # Setup output buffers
+        prior_mean, prior_std = \
+            common.StepBuffer(t_max), common.StepBuffer(t_max)
+        infer_mean, infer_std = \
+            common.StepBuffer(t_max), common.StepBuffer(t_max)
+        samples = common.StepBuffer(t_max)
+
+        # Iterate backwards in time if direction is backward
+        t_rng = (range(t_max-1, -1, -1) if direction == 'bwd'
+                 else range(t_max))
+
+        for i, t in enumerate(t_rng):
+            if i == 0:
                 # Use global prior p(z) at t = 0 or t = t_max
                 prior_mean_t, prior_std_t = glb_mean, glb_std
             else:
-                # Compute prior p(z|z_prev) at time t
-                prior_mean_t, prior_std_t =\
-                    self.z_next(z_t, direction, (glb_mean, glb_std))
-            prior_mean.append(prior_mean_t)
-            prior_std.append(prior_std_t)
+                # Use prior p(z|z_prev) computed in the previous step
+                prior_mean_t, prior_std_t = nxt_mean, nxt_std
+            prior_mean[t], prior_std[t] = prior_mean_t, prior_std_t
+
+            # Combine prior with inferred distributions (product of experts)
+            infer_mean_t, infer_std_t =\
+                self.combine_prior(prior_mean_t, prior_std_t,
+                                   obs_prec[t], obs_wmean[t], eps)
+            infer_mean[t], infer_std[t] = infer_mean_t, infer_std_t
+
+            # Sample particles from inferred distribution, and compute
+            # prior p(z|z_prev) for the next time step (if any)
+            last = (i == t_max - 1)
+            if sample or n_particles > 1 or (i == 0 and sample_init):
+                samples[t], nxt_mean, nxt_std =\
+                    self.z_propagate(infer_mean_t, infer_std_t, direction,
+                                     (glb_mean, glb_std), n_particles,
+                                     particle_chunk, propagate=not last)
+            else:
+                samples[t] = infer_mean_t
+                if not last:
+                    nxt_mean, nxt_std = self.z_next(infer_mean_t.unsqueeze(0),
+                                                    direction,
+                                                    (glb_mean, glb_std))
 
-            # Concatenate means and standard deviations
-            z_mean_t = torch.cat([prior_mean_t.unsqueeze(0), z_mean[:,t]], 0)
-            z_std_t = torch.cat([prior_std_t.unsqueeze(0), z_std[:,t]], 0)
-            masks = torch.cat([prior_mask_t.unsqueeze(0), z_masks[:,t]], 0)
+        infer = (infer_mean.stack(), infer_std.stack())
+        prior = (prior_mean.stack(), prior_std.stack())
 
-            # Combine distributions using product of experts
-            infer_mean_t, infer_std_t = \
-                self.product_of_experts(z_mean_t, z_std_t, masks)
-            infer_mean.append(infer_mean_t)
-            infer_std.append(infer_std_t)
+        return infer, prior, samples.stack()
 
-            # Sample particles from inferred distribution
-            if sample or n_particles > 1 or (len(samples)==0 and sample_init):
-                z_t = self._sample_gauss(
-                    infer_mean_t.expand(n_particles, -1, -1),
-                    infer_std_t.expand(n_particles, -1, -1))
-                samples.append(z_t.mean(dim=0))
-            else:
-                z_t = infer_mean_t.unsqueeze(0)
-                samples.append(infer_mean_t)
+    def filter_init(self, b_dim):
+        """Returns initial state for online filtering of B sequences."""
+        glb_mean, glb_std, _ = self.prior((b_dim, 1))
+        return FilterState(0, glb_mean, glb_std, None, None, None)
+
+    def filter_step(self, state, inputs, sample=True, n_particles=1,
+                    sample_init=False, particle_chunk=None):
+        """Performs one online forward filtering update given the
+        observations for a single frame, without revisiting history.
+
+        Parameters
+        ----------
+        state : FilterState
+            state returned by filter_init or a previous call
+            if None, a new state is initialized from the global prior,
+            which requires at least one modality to be present
+        inputs : dict of str : torch.tensor
+            keys are modality names, tensors are (B, D, ...) for the
+            current frame, missing modalities may be omitted or set to NaN
+        sample : bool
+            sample from z_t if true, use the mean otherwise
+        n_particles : int
+            number of filtering particles, overrides sample flag if > 1
+        sample_init : bool
+            whether to sample for the initial frame
+        particle_chunk : int
+            max. number of particles to process at once (default : all)
+
+        Returns
+        -------
+        state : FilterState
+            updated filtering state, where (infer_mean, infer_std) is the
+            cond. posterior over z_t for the current frame, and
+            (prior_mean, prior_std) is the prior for the next frame
+        """
+        inputs = {m : inputs[m].unsqueeze(0) for m in inputs
+                  if m in self.modalities}
+        if state is None:
+            if len(inputs) == 0:
+                raise Exception("Batch size of an empty frame is unknown, "
+                                "initialize state with filter_init first.")
+            b_dim = inputs[list(inputs.keys())[0]].shape[1]
+            state = self.filter_init(b_dim)
+        obs_prec, obs_wmean = self.encode_frame(inputs, state)
+        return self._filter_update(state, obs_prec, obs_wmean, sample,
+                                   n_particles, sample_init, particle_chunk)
+
+    def encode_frame(self, inputs, state):
+        """Returns natural parameters inferred from a single frame,
+        which are zero if no modality is present."""
+        if len(inputs) == 0:
+            zeros = state.prior_mean.new_zeros(state.prior_mean.shape)
+            return zeros, zeros
+        obs_prec, obs_wmean, _ = \
+            self.encode(inputs, combine=True, natural=True)
+        return obs_prec[0], obs_wmean[0]
+
+    def _filter_update(self, state, obs_prec, obs_wmean, sample=True,
+                       n_particles=1, sample_init=False, particle_chunk=None):
+        """Combines the prior in state with natural observation terms,
+        then propagates to the next frame."""
+        b_dim = state.prior_mean.shape[0]
+        glb_mean, glb_std, _ = self.prior((b_dim, 1))
+
+        # Combine prior with inferred distributions (product of experts)
+        infer_mean, infer_std = self.combine_prior(
+            state.prior_mean, state.prior_std, obs_prec, obs_wmean)
 
-        # Concatenate outputs to tensor, reversing if necessary
-        infer = (torch.stack(rv(infer_mean)), torch.stack(rv(infer_std)))
-        prior = (torch.stack(rv(prior_mean)), torch.stack(rv(prior_std)))
-        samples = torch.stack(rv(samples))
+        # Sample particles and compute prior for the next frame
+        if sample or n_particles > 1 or (state.t == 0 and sample_init):
+            z, nxt_mean, nxt_std =\
+                self.z_propagate(infer_mean, infer_std, 'fwd',
+                                 (glb_mean, glb_std), n_particles,
+                                 particle_chunk)
+        else:
+            z = infer_mean
+            nxt_mean, nxt_std = self.z_next(infer_mean.unsqueeze(0), 'fwd',
+                                            (glb_mean, glb_std))
+
+        return FilterState(state.t + 1, nxt_mean, nxt_std,
+                           infer_mean, infer_std, z)
+
+    def smooth_init(self, b_dim, lag):
+        """Returns initial state for online fixed-lag smoothing."""
+        return SmootherState(lag, deque(), self.filter_init(b_dim))
+
+    def smooth_step(self, state, inputs, sample=True, flt_particles=1,
+                    smt_particles=1, sample_init=False, particle_chunk=None):
+        """Performs one online fixed-lag smoothing update, emitting the
+        smoothed estimate for the frame L steps before the current one.
+
+        This approximates the 'fsmooth' mode of forward, with the backward
+        filtering pass truncated to the L frames after each estimate, so
+        each update costs O(L) instead of O(T). Encodings of the last L+1
+        frames are kept in a ring buffer, and are not recomputed.
+
+        Parameters
+        ----------
+        state : SmootherState
+            state returned by smooth_init or a previous call
+            (updated in-place)
+        inputs : dict of str : torch.tensor
+            keys are modality names, tensors are (B, D, ...) for the
+            current frame, missing modalities may be omitted or set to NaN
+        sample : bool
+            sample from z_t if true, use the mean otherwise
+        flt_particles : int
+            number of particles for the backward filtering pass
+        smt_particles : int
+            number of particles for the forward smoothing pass
+        sample_init : bool
+            whether to sample for the initial frame
+        particle_chunk : int
+            max. number of particles to process at once (default : all)
+
+        Returns
+        -------
+        state : SmootherState
+            updated smoothing state
+        smoothed : FilterState or None
+            state of forward smoothing pass after the frame L steps ago,
+            where (infer_mean, infer_std) is its smoothed posterior,
+            None if fewer than L+1 frames have been seen
+        """
+        inputs = {m : inputs[m].unsqueeze(0) for m in inputs
+                  if m in self.modalities}
+        state.obs.append(self.encode_frame(inputs, state.fwd))
+        if len(state.obs) <= state.lag:
+            return state, None
+        state = self._smooth_update(state, sample, flt_particles,
+                                    smt_particles, sample_init, particle_chunk)
+        return state, state.fwd
+
+    def smooth_flush(self, state, sample=True, flt_particles=1,
+                     smt_particles=1, sample_init=False, particle_chunk=None):
+        """Emits smoothed estimates for all frames left in the buffer,
+        once the sequence has ended. See smooth_step for arguments.
 
-        return infer, prior, samples
+        Returns
+        -------
+        state : SmootherState
+            updated smoothing state, with an empty buffer
+        smoothed : list of FilterState
+            states of forward smoothing pass for remaining frames
+        """
+        smoothed = []
+        while len(state.obs) > 0:
+            state = self._smooth_update(state, sample, flt_particles,
+                                        smt_particles, sample_init,
+                                        particle_chunk)
+            smoothed.append(state.fwd)
+        return state, smoothed
+
+    def _smooth_update(self, state, sample=True, flt_particles=1,
+                       smt_particles=1, sample_init=False,
+                       particle_chunk=None):
+        """Smooths the oldest frame in the buffer, then removes it."""
+        obs_prec, obs_wmean = state.obs[0]
+        # Introduce [p(z_t)]^-1 into the product of Gaussians
+        inv_mean, inv_std, _ = self.prior((1, 1))
+        inv_prec, inv_wmean = self.to_natural(inv_mean, -inv_std)
+        obs_prec, obs_wmean = obs_prec + inv_prec, obs_wmean + inv_wmean
+        if len(state.obs) > 1:
+            # Filter backwards over the buffered frames to get
+            # p(z_t|x_{t+1:t+L}), unless this is the latest frame
+            win_prec, win_wmean = [torch.stack(p) for p in zip(*state.obs)]
+            _, (flt_mean, flt_std), _ = \
+                self.z_filter_natural(win_prec, win_wmean, direction='bwd',
+                                      sample=sample, n_particles=flt_particles,
+                                      particle_chunk=particle_chunk)
+            flt_prec, flt_wmean = self.to_natural(flt_mean[0], flt_std[0])
+            obs_prec, obs_wmean = obs_prec + flt_prec, obs_wmean + flt_wmean
+        fwd = self._filter_update(state.fwd, obs_prec, obs_wmean, sample,
+                                  smt_particles, sample_init, particle_chunk)
+        state.obs.popleft()
+        return state._replace(fwd=fwd)
+
+    def combine_prior(self, mean, std, obs_prec, obs_wmean, eps=1e-8):
+        """Combines a prior with inferred distributions, given the summed
+        natural parameters of the latter, returning mean and std."""
+        prior_prec, prior_wmean = self.to_natural(mean, std, eps=eps)
+        return self.from_natural(prior_prec + obs_prec,
+                                 prior_wmean + obs_wmean)
 
     def sample(self, t_max, b_dim, direction='fwd'):
         """Generates a sequence of the input data by sampling."""
@@ -437,6 +832,15 @@ class MultiDMM(MultiDGTS):
            number of filtering particles (default : 1)
         smt_particles : int
            number of smoothing particles (default : 1)
+        particle_chunk : int
+           max. number of particles to process at once, bounding memory
+           use when many particles are used (default : all)
+        obs : (torch.tensor, torch.tensor, torch.tensor)
+           precomputed output of encode for all modalities, in which case
+           inputs is only used to select which modalities to condition on
+        masks : dict of str : torch.tensor
+           optional (T, B) observation masks for each modality,
+           in which case inputs are assumed to be zero-filled (not NaN)
 
         Returns
         -------
@@ -453,50 +857,83 @@ class MultiDMM(MultiDGTS):
         sample_init = kwargs.get('sample_init', False)
         flt_particles = kwargs.get('flt_particles', 1)
         smt_particles = kwargs.get('smt_particles', 1)
+        particle_chunk = kwargs.get('particle_chunk')
         t_max, b_dim = max(lengths), len(lengths)
 
-        # Helper function to append tuple of 3D tensors to 4D tensor
-        cons = lambda a, b : torch.stack(a.unbind(0) + b, dim=0)
-
-        # Infer z_t from x_t without temporal information
-        obs_mean, obs_std, obs_mask = self.encode(inputs)
+        # Infer z_t from x_t without temporal information, summing the
+        # natural parameters across modalities once for both passes
+        obs = kwargs.get('obs')
+        if obs is None:
+            obs_prec, obs_wmean, _ = \
+                self.encode(inputs, combine=True, natural=True,
+                            obs_masks=kwargs.get('masks'))
+        else:
+            # Mask out cached encodings of modalities not in inputs
+            obs_mean, obs_std, obs_mask = obs
+            sel = torch.tensor([m in inputs for m in self.modalities],
+                               dtype=torch.uint8, device=self.device)
+            obs_mask = obs_mask * sel.view(-1, 1, 1)
+            obs_prec, obs_wmean = self.to_natural(obs_mean, obs_std, obs_mask)
+            obs_prec, obs_wmean = obs_prec.sum(dim=0), obs_wmean.sum(dim=0)
 
         # Filtering pass
         direction = 'fwd' if mode in ['ffilter', 'bsmooth'] else 'bwd'
         flt_init = sample_init if mode in ['ffilter', 'bfilter'] else False
         infer, prior, z_samples = \
-            self.z_filter(obs_mean, obs_std, obs_mask, direction=direction,
-                          sample=sample, n_particles=flt_particles,
-                          sample_init=flt_init)
+            self.z_filter_natural(obs_prec, obs_wmean, direction=direction,
+                                  sample=sample, n_particles=flt_particles,
+                                  sample_init=flt_init,
+                                  particle_chunk=particle_chunk)
 
         # Smoothing pass
         if mode in ['fsmooth', 'bsmooth']:
             direction = 'fwd' if mode == 'fsmooth' else 'bwd'
             # Introduce [p(z_t)]^-1 into the product of Gaussians
-            inv_mean, inv_std, inv_mask = self.prior((t_max, b_dim, 1))
+            inv_mean, inv_std, _ = self.prior((1, 1))
             inv_std = -inv_std
+            inv_prec, inv_wmean = self.to_natural(inv_mean, inv_std)
             # Collect p(z_t|x_{t+1:T}) from output of filtering pass
             flt_mean, flt_std = prior
             flt_mask =\
                 torch.ones((t_max, b_dim), dtype=torch.uint8).to(self.device)
             flt_mask[-1] = 0 * flt_mask[-1]
+            flt_prec, flt_wmean = self.to_natural(flt_mean, flt_std, flt_mask)
+            # Add to the observation terms instead of re-encoding
             infer, prior, z_samples = \
-                self.z_filter(cons(obs_mean, (flt_mean, inv_mean)),
-                              cons(obs_std, (flt_std, inv_std)),
-                              cons(obs_mask, (flt_mask, inv_mask)),
-                              direction=direction,
-                              sample=sample, n_particles=smt_particles,
-                              sample_init=sample_init)
+                self.z_filter_natural(obs_prec + flt_prec + inv_prec,
+                                      obs_wmean + flt_wmean + inv_wmean,
+                                      direction=direction, sample=sample,
+                                      n_particles=smt_particles,
+                                      sample_init=sample_init,
+                                      particle_chunk=particle_chunk)
 
         # Decode sampled z to reconstruct inputs
         recon = self.decode(z_samples)
 
         return infer, prior, recon
 
-    def kld_prior(self, n_particles, direction='fwd'):
+    def stack_inputs(self, inputs, subsets, kwargs):
+        """Stacks cached encodings across modality subsets if provided,
+        instead of stacking and re-encoding the inputs."""
+        if kwargs.get('obs') is None:
+            return super(MultiDMM, self).stack_inputs(inputs, subsets, kwargs)
+        n_sets = len(subsets)
+        obs_mean, obs_std, obs_mask = kwargs['obs']
+        # Mask out encodings of modalities outside each subset
+        sel = torch.tensor([[m in s for s in subsets] for m in self.modalities],
+                           dtype=torch.uint8, device=self.device)
+        obs_mask = obs_mask.unsqueeze(2) * sel.view(self.n_mods, 1, n_sets, 1)
+        obs = (obs_mean.repeat(1, 1, n_sets, 1),
+               obs_std.repeat(1, 1, n_sets, 1),
+               obs_mask.flatten(2, 3))
+        # Inputs need not be stacked, since only their keys are used
+        return inputs, dict(kwargs, obs=obs)
+
+    def kld_prior(self, n_particles, direction='fwd', particle_chunk=None):
         """Compute KL divergence between E[p(z_next|z)] and p(z)."""
         glb_mean, glb_std, _ = self.prior((1, 1, 1))
-        nxt_mean, nxt_std = self.z_sample(1, 1, direction, True, n_particles)
+        nxt_mean, nxt_std = self.z_sample(1, 1, direction, True, n_particles,
+                                          particle_chunk=particle_chunk)
         loss = losses.kld_gauss(glb_mean, glb_std, nxt_mean, nxt_std)
         return loss
 
@@ -522,6 +959,9 @@ class MultiDMM(MultiDGTS):
         match_particles : int
             n_particles for prior matching computation
 
+        Each modality is encoded once, and the encodings are shared
+        across the filtering, smoothing and unimodal ELBO terms.
+
         Returns
         -------
         loss : torch.tensor
@@ -534,15 +974,22 @@ class MultiDMM(MultiDGTS):
         match_mult = kwargs.get('match_mult', 0.01)
         train_particles = kwargs.get('train_particles', 25)
         match_particles = kwargs.get('match_particles', 50)
+        particle_chunk = kwargs.get('particle_chunk')
         t_max, b_dim = mask.shape[:2]
 
+        # Encode inputs once if all modalities are present
+        if all(m in inputs for m in self.modalities):
+            kwargs['obs'] = self.encode({m : inputs[m] for m in
+                                         self.modalities},
+                                        obs_masks=kwargs.get('masks'))
+
         loss = 0
         # Compute prior matching loss
         if match_mult > 0:
             loss += (match_mult * kld_mult * mask.sum().float() *
-                     self.kld_prior(match_particles, 'fwd'))
+                     self.kld_prior(match_particles, 'fwd', particle_chunk))
             loss += (match_mult * kld_mult * mask.sum().float() *
-                     self.kld_prior(match_particles, 'bwd'))
+                     self.kld_prior(match_particles, 'bwd', particle_chunk))
         # Compute loss when filtering
         loss += f_mult * super(MultiDMM, self).\
             step(inputs, mask, kld_mult, rec_mults, targets, uni_loss,
@@ -580,3 +1027,44 @@ if __name__ == "__main__":
     print("Predicted:")
     for x, y in zip(recon['spiral-x'][0], recon['spiral-y'][0]):
         print("{:+0.3f}, {:+0.3f}".format(x.item(), y.item()))
+    print("Checking that particle chunking preserves results...")
+    small = MultiDMM(['spiral-x', 'spiral-y'], [1, 1], z_dim=5, h_dim=20,
+                     device=torch.device('cpu'))
+    small.eval()
+    mean, std = torch.randn(3, small.z_dim), torch.rand(3, small.z_dim)
+    torch.manual_seed(0)
+    ref = small.z_propagate(mean, std, n_particles=20)
+    for chunk in [1, 7, 20]:
+        torch.manual_seed(0)
+        out = small.z_propagate(mean, std, n_particles=20,
+                                particle_chunk=chunk)
+        assert all(torch.allclose(r, o, atol=1e-6) for r, o in zip(ref, out))
+    print("OK")
+    print("Checking that scripted filtering matches eager filtering...")
+    import time
+    data, mask, lengths, order = \
+        seq_collate_dict([dataset[i] for i in range(4)])
+    kwargs = {'lengths': lengths, 'flt_particles': 7, 'particle_chunk': 3}
+    outputs, grads, times = [], [], []
+    for jit in [False, True]:
+        small.jit = jit
+        # Time 10 passes after 3 warm-up passes, which TorchScript
+        # uses to profile and optimize the scripted loop
+        with torch.no_grad():
+            for i in range(13):
+                if i == 3:
+                    t_start = time.time()
+                small(data, **kwargs)
+        times.append((time.time() - t_start) / 10 / max(lengths))
+        torch.manual_seed(0)
+        infer, prior, recon = small(data, **kwargs)
+        outputs.append(infer + prior + recon['spiral-x'])
+        loss = sum(out.sum() for out in outputs[-1])
+        grads.append(torch.autograd.grad(loss, small.parameters(),
+                                         allow_unused=True))
+    assert all(torch.allclose(e, s, atol=1e-6)
+               for e, s in zip(*outputs))
+    assert all((e is None and s is None) or torch.allclose(e, s, atol=1e-5)
+               for e, s in zip(*grads))
+    print("OK, {:0.3f} ms (eager) vs {:0.3f} ms (jit) per step".\
+          format(times[0] * 1e3, times[1] * 1e3))
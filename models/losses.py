@@ -4,23 +4,45 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
-from builtins import range
 import math
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+def observed(x, mask=None, check_nan=True):
+    """Returns x with NaNs zeroed, along with a mask of observed entries.
+
+        The mask is left unexpanded so that it broadcasts against x, and x is
+        only copied if it actually contains NaNs. If check_nan is False, x is
+        assumed to be NaN-free and mask must be provided.
+    """
+    if mask is not None:
+        shape = list(mask.shape) + [1] * (x.dim() - mask.dim())
+        mask = mask.view(*shape)
+        if not check_nan:
+            return x, mask
+    nan = torch.isnan(x)
+    mask = (1 - nan) if mask is None else (1 - nan) * mask
+    if nan.any():
+        x = x.masked_fill(nan, 0)
+    return x, mask
+
+def masked_sum(element, mask=None):
+    """Sums element over masked entries by multiplying with the mask,
+    avoiding the dynamically-shaped copies made by masked_select."""
+    if mask is None:
+        return torch.sum(element)
+    return torch.sum(element * mask.type_as(element))
+
 def kld_gauss(mean_1, std_1, mean_2, std_2, mask=None):
     kld_element =  (2 * torch.log(std_2) - 2 * torch.log(std_1) + 
         (std_1.pow(2) + (mean_1 - mean_2).pow(2)) /
         std_2.pow(2) - 1)
-    if mask is not None:
-        kld_element = kld_element.masked_select(mask)
-    kld =  0.5 * torch.sum(kld_element)
+    kld =  0.5 * masked_sum(kld_element, mask)
     return kld
 
-def nll_bernoulli(theta, x, mask=None):
+def nll_bernoulli(theta, x, mask=None, check_nan=True):
     """Returns Bernoulli negative log-likelihood (summed across inputs).
 
         theta : torch.tensor of shape (T, B, D, ...)
@@ -28,62 +50,58 @@ def nll_bernoulli(theta, x, mask=None):
         x : torch.tensor of shape (T, B, D, ...)
             Tensor of observations
         mask : torch.tensor of shape (T, B)
+        check_nan : bool
+            whether to also mask out NaNs in x, which can be skipped
+            if x is NaN-free (e.g. zero-filled) and mask is provided
 
         Here, T = n_timesteps, B = batch_size, and (D, ...) are the input dims.
     """
-    if mask is None:
-        mask = 1 - torch.isnan(x)
-    else:
-        shape = list(mask.shape) + [1] * (x.dim() - mask.dim())
-        mask = (1 - torch.isnan(x)) * mask.view(*shape)
-    theta = theta.masked_select(mask)
-    x = x.masked_select(mask)
-    nll = F.binary_cross_entropy(theta, x, reduction='sum')
+    x, mask = observed(x, mask, check_nan)
+    nll_element = F.binary_cross_entropy(theta, x, reduction='none')
+    nll = masked_sum(nll_element, mask)
     return nll
 
-def nll_categorical(probs, x, mask=None):
+def nll_categorical(probs, x, mask=None, check_nan=True, eps=1e-8):
     """Returns categorical negative log-likelihood (summed across inputs).
 
         probs : torch.tensor of shape (T, B, K, D, ...)
-            Probability of heads
+            Probability of each category
         x : torch.tensor of shape (T, B, D, ...)
             Tensor of observed category labels (not one-hot).
         mask : torch.tensor of shape (T, B)
+        check_nan : bool
+            whether to also mask out NaNs in x, which can be skipped
+            if x is NaN-free (e.g. zero-filled) and mask is provided
+        eps : float
+            lower bound on probabilities before taking logs
 
         Here, T = n_timesteps, B = batch_size, K = n_categories,
         and (D, ...) are the input dims.
     """
-    if mask is None:
-        mask = 1 - torch.isnan(x)
-    else:
-        shape = list(mask.shape) + [1] * (x.dim() - mask.dim())
-        mask = (1 - torch.isnan(x)) * mask.view(*shape)
-    # Mask probs and reshape into correct format for F.nll_loss
-    probs = torch.stack([probs[:,:,k:k+1].masked_select(mask)
-                         for k in range(probs.shape[2])], dim=-1)
-    x = x.masked_select(mask)
-    nll = F.nll_loss(probs, x.long(), reduction='sum')
+    x, mask = observed(x, mask, check_nan)
+    # Add singleton input dims to probs if needed, e.g. (T, B, K, 1)
+    probs = probs.view(*(list(probs.shape[:3]) + list(x.shape[2:])))
+    # Gather probability of observed labels, then take logs of just those
+    probs = probs.gather(2, x.long().unsqueeze(2)).squeeze(2)
+    nll_element = -probs.clamp(min=eps).log()
+    nll = masked_sum(nll_element, mask)
     return nll
 
-def nll_gauss(mean, std, x, mask=None):
+def nll_gauss(mean, std, x, mask=None, check_nan=True):
     """Returns Gaussian negative log-likelihood (summed across inputs).
 
         mean : torch.tensor of shape (T, B, D, ...)
         std : torch.tensor of shape (T, B, D, ...)
         x : torch.tensor of shape (T, B, D, ...)
         mask : torch.tensor of shape (T, B)
+        check_nan : bool
+            whether to also mask out NaNs in x, which can be skipped
+            if x is NaN-free (e.g. zero-filled) and mask is provided
 
         Here, T = n_timesteps, B = batch_size, and (D, ...) are the input dims.
     """
-    if mask is None:
-        mask = 1 - torch.isnan(x)
-    else:
-        shape = list(mask.shape) + [1] * (x.dim() - mask.dim())
-        mask = (1 - torch.isnan(x)) * mask.view(*shape)
-    x = x.clone().detach()
-    x[torch.isnan(x)] = 0.0
+    x, mask = observed(x, mask, check_nan)
     nll_element = ( 0.5 * ((x-mean) / std).pow(2) + std.log() +
                     0.5 * math.log(2 * math.pi) )
-    nll_element = nll_element.masked_select(mask)
-    nll = torch.sum(nll_element)
+    nll = masked_sum(nll_element, mask)
     return nll
@@ -102,7 +102,7 @@ class MultiVRNN(MultiDGTS):
             self.dec.update(decoders)
 
         # Prior p(z) = N(mu(h), sigma(h))
-        self.prior = GaussianMLP(h_dim, z_dim, h_dim)
+        self.prior = common.GaussianMLP(h_dim, z_dim, h_dim)
 
         # Recurrence h_next = f(z,h) or f(x,z,h)
         if recur_mode == 'use_inputs':
@@ -130,15 +130,44 @@ class MultiVRNN(MultiDGTS):
            lengths of all input sequences in the batch
         sample: bool
            whether to sample from z_t (default) or return MAP estimate
+        masks : dict of str : torch.tensor
+           optional (T, B) observation masks for each modality,
+           in which case inputs are assumed to be zero-filled (not NaN)
         """
         lengths, sample = kwargs.get('lengths'), kwargs.get('sample', True)
+        obs_masks = kwargs.get('masks')
         batch_size, seq_len = len(lengths), max(lengths)
 
-        # Initialize list accumulators
-        prior_mean, prior_std = [], []
-        infer_mean, infer_std = [], []
-        rec_mean = {m: [] for m in self.modalities}
-        rec_std = {m: [] for m in self.modalities}
+        # Initialize output buffers
+        prior_mean, prior_std = \
+            common.StepBuffer(seq_len), common.StepBuffer(seq_len)
+        infer_mean, infer_std = \
+            common.StepBuffer(seq_len), common.StepBuffer(seq_len)
+        rec_mean = {m: common.StepBuffer(seq_len) for m in self.modalities}
+        rec_std = {m: common.StepBuffer(seq_len) for m in self.modalities}
+        # Decoder inputs, if decoding is deferred until after the loop
+        dec_in = common.StepBuffer(seq_len)
+
+        # Compute masks and extract features for all timesteps at once,
+        # since these do not depend on the hidden state
+        inputs = {m : inputs[m] for m in self.modalities if m in inputs}
+        nan_masks, masks_x, inputs_x, phi_x = dict(), dict(), dict(), dict()
+        for m in inputs:
+            if obs_masks is not None and m in obs_masks:
+                # Use provided masks for zero-filled inputs
+                masks_x[m], input_m = obs_masks[m], inputs[m].detach()
+                shape = list(masks_x[m].shape) + [1] * (input_m.dim()-2)
+                nan_masks[m] = (masks_x[m] == 0).view(*shape).\
+                    expand_as(input_m)
+            else:
+                nan_masks[m] = torch.isnan(inputs[m])
+                masks_x[m] = 1 - nan_masks[m].flatten(2, -1).any(dim=-1)
+                input_m = inputs[m].clone().detach()
+                input_m[nan_masks[m]] = 0.0
+            phi_x[m] = self.phi[m](input_m).unbind(0)
+            if self.recur_mode == 'use_inputs':
+                nan_masks[m], inputs_x[m] = \
+                    nan_masks[m].unbind(0), input_m.unbind(0)
 
         # Initialize hidden state
         h = self.h0.repeat(1, batch_size, 1)
@@ -150,8 +179,7 @@ class MultiVRNN(MultiDGTS):
             else:
                 prior_mean_t = self.z0_mean.repeat(batch_size, 1)
                 prior_std_t = self.z0_std.repeat(batch_size, 1)
-            prior_mean.append(prior_mean_t)
-            prior_std.append(prior_std_t)
+            prior_mean[t], prior_std[t] = prior_mean_t, prior_std_t
 
             # Accumulate list of the means and std for z
             z_mean_t = [prior_mean_t]
@@ -164,13 +192,9 @@ class MultiVRNN(MultiDGTS):
                 # Ignore missing modalities
                 if m not in inputs:
                     continue
-                # Mask out NaNs
-                mask = (1 - torch.isnan(inputs[m][t]).any(dim=1))
-                input_m_t = inputs[m][t].clone().detach()
-                input_m_t[torch.isnan(input_m_t)] = 0.0
-                # Extract features
-                phi_m_t = self.phi[m](input_m_t)
-                enc_in_t = torch.cat([phi_m_t, h[-1]], 1)
+                # Use precomputed NaN masks and features
+                mask = masks_x[m][t]
+                enc_in_t = torch.cat([phi_x[m][t], h[-1]], 1)
                 # Compute mean and std of latent z given modality m
                 z_mean_m_t, z_std_m_t = self.enc[m](enc_in_t)
                 # Concatenate to list of inferred means and stds
@@ -185,8 +209,7 @@ class MultiVRNN(MultiDGTS):
             infer_mean_t, infer_std_t = \
                 self.product_of_experts(z_mean_t, z_std_t, mask)
 
-            infer_mean.append(infer_mean_t)
-            infer_std.append(infer_std_t)
+            infer_mean[t], infer_std[t] = infer_mean_t, infer_std_t
 
             if sample:
                 # Sample z from approximate posterior q(z|x)
@@ -197,21 +220,25 @@ class MultiVRNN(MultiDGTS):
 
             # Decode sampled z to reconstruct inputs
             dec_in_t = torch.cat([phi_zq_t, h[-1]], 1)
-            for m in self.modalities:
-                rec_mean_m_t, rec_std_m_t = self.dec[m](dec_in_t)
-                rec_mean[m].append(rec_mean_m_t)
-                rec_std[m].append(rec_std_m_t)
+            if self.recur_mode != 'use_inputs':
+                # Defer decoding since reconstructions are not fed back
+                dec_in[t] = dec_in_t
+            else:
+                rec_mean_t = dict()
+                for m in self.modalities:
+                    rec_mean_t[m], rec_std[m][t] = self.dec[m](dec_in_t)
+                    rec_mean[m][t] = rec_mean_t[m]
 
             if self.recur_mode == 'use_inputs':
                 # Impute missing inputs then extract features
                 phi_x_t = []
                 for m in self.modalities:
                     if m not in inputs:
-                        input_m_t = rec_mean[m][-1].detach()
+                        input_m_t = rec_mean_t[m].detach()
                     else:
-                        input_m_t = inputs[m][t].clone().detach()
-                        nan_mask = torch.isnan(input_m_t)
-                        input_m_t[nan_mask] = rec_mean[m][-1][nan_mask]
+                        input_m_t = torch.where(nan_masks[m][t],
+                                                rec_mean_t[m],
+                                                inputs_x[m][t])
                     phi_m_t = self.phi[m](input_m_t)
                     phi_x_t.append(phi_m_t)
                 phi_x_t = torch.cat(phi_x_t, 1)
@@ -224,20 +251,24 @@ class MultiVRNN(MultiDGTS):
                 # Compute h using inferred z (h_next = f(x,z,h))
                 _, h = self.rnn(phi_zq_t.unsqueeze(0), h)
 
-        # Concatenate lists to tensors
-        infer = (torch.stack(infer_mean), torch.stack(infer_std))
-        prior = (torch.stack(prior_mean), torch.stack(prior_std))
-        for m in self.modalities:
-            rec_mean[m] = torch.stack(rec_mean[m])
-            rec_std[m] = torch.stack(rec_std[m])
+        # Concatenate buffers to tensors
+        infer = (infer_mean.stack(), infer_std.stack())
+        prior = (prior_mean.stack(), prior_std.stack())
+        if self.recur_mode != 'use_inputs':
+            rec_mean, rec_std = self.decode(dec_in.stack())
+        else:
+            for m in self.modalities:
+                rec_mean[m] = rec_mean[m].stack()
+                rec_std[m] = rec_std[m].stack()
         recon = (rec_mean, rec_std)
 
         return infer, prior, recon
 
     def sample(self, batch_size, seq_len):
         """Generates a sequence of the input data by sampling."""
-        rec_mean = {m: [] for m in self.modalities}
-        rec_std = {m: [] for m in self.modalities}
+        rec_mean = {m: common.StepBuffer(seq_len) for m in self.modalities}
+        rec_std = {m: common.StepBuffer(seq_len) for m in self.modalities}
+        dec_in = common.StepBuffer(seq_len)
         h = self.h0.repeat(1, batch_size, 1)
 
         for t in range(seq_len):
@@ -254,16 +285,20 @@ class MultiVRNN(MultiDGTS):
 
             # Decode sampled z to reconstruct inputs
             dec_in_t = torch.cat([phi_z_t, h[-1]], 1)
-            for m in self.modalities:
-                rec_mean_m_t, rec_std_m_t = self.dec[m](dec_in_t)
-                rec_mean[m].append(rec_mean_m_t)
-                rec_std[m].append(rec_std_m_t)
+            if self.recur_mode != 'use_inputs':
+                # Defer decoding since reconstructions are not fed back
+                dec_in[t] = dec_in_t
+            else:
+                rec_mean_t = dict()
+                for m in self.modalities:
+                    rec_mean_t[m], rec_std[m][t] = self.dec[m](dec_in_t)
+                    rec_mean[m][t] = rec_mean_t[m]
 
             if self.recur_mode == 'use_inputs':
                 # Extract features from reconstructions
                 phi_x_t = []
                 for m in self.modalities:
-                    phi_m_t = self.phi[m](rec_mean[m][-1])
+                    phi_m_t = self.phi[m](rec_mean_t[m])
                     phi_x_t.append(phi_m_t)
                 phi_x_t = torch.cat(phi_x_t, 1)
 
@@ -273,10 +308,36 @@ class MultiVRNN(MultiDGTS):
             else:
                 _, h = self.rnn(phi_z_t.unsqueeze(0), h)
 
+        if self.recur_mode != 'use_inputs':
+            return self.decode(dec_in.stack())
         for m in self.modalities:
-            rec_mean[m] = torch.stack(rec_mean[m])
-            rec_std[m] = torch.stack(rec_std[m])
+            rec_mean[m] = rec_mean[m].stack()
+            rec_std[m] = rec_std[m].stack()
+
+        return rec_mean, rec_std
 
+    def decode(self, dec_in):
+        """Decodes inputs for all timesteps in a single batched call.
+
+        Parameters
+        ----------
+        dec_in : torch.tensor
+           decoder inputs [phi(z_t), h_t], shape is (T, B, 2 * h_dim)
+
+        Returns
+        -------
+        rec_mean : dict of str : torch.tensor
+           reconstructed means for each modality, shape (T, B, ...)
+        rec_std : dict of str : torch.tensor
+           reconstructed stds for each modality, shape (T, B, ...)
+        """
+        t_max, b_dim = dec_in.shape[:2]
+        rec_mean, rec_std = dict(), dict()
+        for m in self.modalities:
+            rec_mean_m, rec_std_m = self.dec[m](dec_in.flatten(0, 1))
+            rec_shape = [t_max, b_dim] + list(rec_mean_m.shape[1:])
+            rec_mean[m] = rec_mean_m.reshape(*rec_shape)
+            rec_std[m] = rec_std_m.reshape(*rec_shape)
         return rec_mean, rec_std
 
 if __name__ == "__main__":
@@ -77,9 +77,17 @@ class SpiralsTrainer(trainer.Trainer):
         print("Loading data...")
         data_dir = os.path.abspath(args.data_dir)
         train_data = SpiralsDataset(modalities, data_dir, args.train_subdir,
-                                    truncate=True, item_as_dict=True)
+                                    truncate=True, item_as_dict=True,
+                                    dtypes=args.storage_dtype,
+                                    keep_orig=not args.drop_orig,
+                                    num_workers=args.load_workers,
+                                    cache_dir=args.cache_dir)
         test_data = SpiralsDataset(modalities, data_dir, args.test_subdir,
-                                   truncate=True, item_as_dict=True)
+                                   truncate=True, item_as_dict=True,
+                                   dtypes=args.storage_dtype,
+                                   keep_orig=not args.drop_orig,
+                                   num_workers=args.load_workers,
+                                   cache_dir=args.cache_dir)
         print("Done.")
         if len(args.normalize) > 0:
             print("Normalizing ", args.normalize, "...")
@@ -80,6 +80,15 @@ class Trainer(object):
     # Data loader arguments
     parser.add_argument('--data_workers', type=int, default=1, metavar='N',
                         help='number of data loader worker threads')
+    parser.add_argument('--load_workers', type=int, default=0, metavar='N',
+                        help='number of processes for loading data files')
+    parser.add_argument('--cache_dir', type=str, default=None, metavar='DIR',
+                        help='directory to cache loaded datasets in')
+    parser.add_argument('--storage_dtype', type=str, default='float64',
+                        metavar='DTYPE',
+                        help='storage dtype (e.g. uint8 for [0,1] data)')
+    parser.add_argument('--drop_orig', action='store_true', default=False,
+                        help='do not keep data from before resampling')
     parser.add_argument('--pin_memory', type=bool, default=True, metavar='B',
                         help='whether to pin memory for CUDA transfer')
 
@@ -94,6 +103,8 @@ class Trainer(object):
     # Arguments for data modification / augmentation during training
     parser.add_argument('--burst_frac', type=float, default=0.1, metavar='F',
                         help='burst error rate during training')
+    parser.add_argument('--obs_masks', action='store_true', default=False,
+                        help='mask (instead of NaN) missing training data')
 
     # Arguments for data modification / augmentation during evaluation
     parser.add_argument('--drop_frac', type=float, default=0.5, metavar='F',
@@ -220,7 +231,8 @@ class Trainer(object):
         data_num, loss = 0, 0.0
         rec_mults = dict(args.rec_mults)
         # Iterate over batches
-        for b_num, (targets, mask, lengths, _) in enumerate(loader):
+        for b_num, batch in enumerate(loader):
+            targets, mask, lengths = batch[:3]
             # Anneal KLD loss multipliers
             b_tot = b_num + epoch*len(loader)
             kld_mult =\
@@ -229,12 +241,22 @@ class Trainer(object):
             mask = mask.to(args.device)
             for m in targets.keys():
                 targets[m] = targets[m].to(args.device)
-            # Introduce burst deletions to improve interpolation
-            inputs = mseq.burst_delete(targets, args.burst_frac, lengths)
-            # Compute batch loss
-            b_loss = model.step(inputs, mask, kld_mult, rec_mults,
-                                targets=targets, lengths=lengths,
-                                **args.train_args)
+            if args.obs_masks:
+                # Introduce burst deletions by unsetting observation masks
+                t_masks = {m: batch[4][m].to(args.device) for m in batch[4]}
+                masks = mseq.burst_delete(targets, args.burst_frac, lengths,
+                                          masks=t_masks)
+                b_loss = model.step(targets, mask, kld_mult, rec_mults,
+                                    targets=targets, lengths=lengths,
+                                    masks=masks, target_masks=t_masks,
+                                    **args.train_args)
+            else:
+                # Introduce burst deletions to improve interpolation
+                inputs = mseq.burst_delete(targets, args.burst_frac, lengths)
+                # Compute batch loss
+                b_loss = model.step(inputs, mask, kld_mult, rec_mults,
+                                    targets=targets, lengths=lengths,
+                                    **args.train_args)
             loss += b_loss
             # Average over number of datapoints before stepping
             b_loss /= sum(lengths)
@@ -492,8 +514,10 @@ class Trainer(object):
         # Split training data into chunks
         train_data = train_data.split(args.split, args.bylen)
         # Batch data using data loaders
+        collate_fn = (mseq.seq_collate_masks if args.obs_masks
+                      else mseq.seq_collate_dict)
         train_loader = DataLoader(train_data, batch_size=args.batch_size,
-                                  collate_fn=mseq.seq_collate_dict,
+                                  collate_fn=collate_fn,
                                   shuffle=True, pin_memory=args.pin_memory,
                                   num_workers=args.data_workers)
         test_loader = DataLoader(test_data, batch_size=args.batch_sz_eval,
@@ -87,7 +87,11 @@ class VidTIMITTrainer(trainer.Trainer):
     def load_data(self, modalities, args):
         print("Loading data...")
         data_dir = os.path.abspath(args.data_dir)
-        all_data = vidTIMIT.VidTIMITDataset(data_dir, item_as_dict=True)
+        all_data = vidTIMIT.VidTIMITDataset(data_dir, item_as_dict=True,
+                                            dtypes=args.storage_dtype,
+                                            keep_orig=not args.drop_orig,
+                                            num_workers=args.load_workers,
+                                            cache_dir=args.cache_dir)
         # Split into train and test set
         train_data = all_data.select([None, ['sa1', 'sa2']], invert=True)
         test_data = all_data.select([None, ['sa1', 'sa2']])
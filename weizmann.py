@@ -98,7 +98,11 @@ class WeizmannTrainer(trainer.Trainer):
     def load_data(self, modalities, args):
         print("Loading data...")
         data_dir = os.path.abspath(args.data_dir)
-        all_data = weizmann.WeizmannDataset(data_dir, item_as_dict=True)
+        all_data = weizmann.WeizmannDataset(data_dir, item_as_dict=True,
+                                            dtypes=args.storage_dtype,
+                                            keep_orig=not args.drop_orig,
+                                            num_workers=args.load_workers,
+                                            cache_dir=args.cache_dir)
         # Leave one person out of training set
         train_data = all_data.select([['shahar'], None], invert=True)
         # Test on left out person